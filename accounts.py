@@ -0,0 +1,116 @@
+import logging
+import time
+
+from chat_cache import DialogCache
+
+logger = logging.getLogger(__name__)
+
+class Account:
+    # Один пользовательский аккаунт Telethon и его статистика для /status
+
+    def __init__(self, name, session_string, dialogs=None):
+        self.name = name
+        self.session_string = session_string
+        self.dialogs = dialogs if dialogs is not None else DialogCache()
+        self.client = None
+        self.handler = None
+        self.scope = None
+        self.events = 0
+        self.skipped = 0
+        self.last_event_at = None
+
+    @property
+    def connected(self):
+        return self.client is not None and self.client.is_connected()
+
+    def record_event(self):
+        self.events += 1
+        self.last_event_at = time.monotonic()
+
+class AccountPool:
+    # Несколько аккаунтов в одном event loop. Каждый чат закреплен за одним
+    # аккаунтом, остальные аккаунты, которые видят этот чат, его события пропускают.
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.owners = {}
+        # Задача догоняющего чтения и перераспределения чатов
+        self.monitoring = None
+        # Догоняющее чтение чатов, сменивших владельца при перераспределении
+        self.catch_up_tasks = set()
+        # Контрольные точки на момент запуска: правки сообщений до них уже не новые
+        self.startup_checkpoints = {}
+
+    @classmethod
+    def from_config(cls, config, primary_dialogs=None):
+        accounts = [Account("main", config["SESSION_STRING"], primary_dialogs)]
+        for index, extra in enumerate(config.get("EXTRA_SESSIONS") or [], 2):
+            accounts.append(Account(extra.get("name") or f"account{index}", extra["SESSION_STRING"]))
+        return cls(accounts)
+
+    @property
+    def primary(self):
+        return self.accounts[0]
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def owns(self, account, chat_id):
+        # Чаты, которых еще нет в разбиении (например, новые), обрабатывают все,
+        # повторные уведомления отсекает общая дедупликация
+        owner = self.owners.get(chat_id)
+        return owner is None or owner == account.name
+
+    def owned_chats(self, account):
+        return [chat_id for chat_id, owner in self.owners.items() if owner == account.name]
+
+    def rebalance(self):
+        # Сначала распределяем чаты, доступные меньшему числу аккаунтов,
+        # и каждый отдаем наименее загруженному из тех, кто его видит.
+        # Отключенные аккаунты чаты не получают. Возвращает чаты, сменившие владельца.
+        visibility = {}
+        for account in self.accounts:
+            if not account.connected:
+                continue
+            for info in account.dialogs.entries():
+                # Личные чаты у каждого аккаунта свои, их не делим
+                if info.type not in ("private", "bot"):
+                    visibility.setdefault(info.chat_id, []).append(account)
+        load = {account.name: 0 for account in self.accounts}
+        owners = {}
+        for chat_id, candidates in sorted(visibility.items(), key=lambda item: (len(item[1]), item[0])):
+            owner = min(candidates, key=lambda account: load[account.name])
+            owners[chat_id] = owner.name
+            load[owner.name] += 1
+        moved = {
+            chat_id: owner for chat_id, owner in owners.items()
+            if chat_id in self.owners and self.owners[chat_id] != owner
+        }
+        self.owners = owners
+        logger.info("Чаты распределены между аккаунтами: %s", load)
+        return moved
+
+    def account(self, name):
+        return next((account for account in self.accounts if account.name == name), None)
+
+    def state(self):
+        # Что влияет на распределение: подключение аккаунтов и их списки диалогов
+        return tuple(
+            (account.name, account.connected, frozenset(info.chat_id for info in account.dialogs.entries()))
+            for account in self.accounts
+        )
+
+    def describe(self):
+        now = time.monotonic()
+        lines = []
+        load = {}
+        for owner in self.owners.values():
+            load[owner] = load.get(owner, 0) + 1
+        for account in self.accounts:
+            last_event = f"{now - account.last_event_at:.0f} с назад" if account.last_event_at else "нет"
+            lines.append(
+                f"{account.name}: {'подключен' if account.connected else 'отключен'}, "
+                f"чатов {load.get(account.name, 0)}, событий {account.events}, "
+                f"пропущено чужих {account.skipped}, последнее событие: {last_event}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,54 @@
+# Микробенчмарк сопоставления упоминаний.
+# Запуск: python benchmarks/bench_matcher.py
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import MentionMatcher
+
+HANDLE_COUNTS = (10, 1_000, 50_000)
+MESSAGES = 2_000
+LEGACY_MESSAGES = 50
+
+def random_handle(rng):
+    return "@" + "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(5, 16)))
+
+def make_messages(rng, handles, count):
+    words = ["привет", "когда", "релиз", "hello", "ok", "посмотри", "тут", "spam"]
+    messages = []
+    for _ in range(count):
+        parts = rng.choices(words, k=rng.randint(5, 40))
+        if rng.random() < 0.3:
+            parts.insert(rng.randrange(len(parts) + 1), rng.choice(handles))
+        if rng.random() < 0.2:
+            parts.insert(rng.randrange(len(parts) + 1), random_handle(rng))
+        messages.append(" ".join(parts))
+    return messages
+
+def legacy_match(tracked_users, text):
+    message_text = text.lower()
+    return [user for user in tracked_users if user.lower() in message_text]
+
+def bench(func, messages):
+    start = time.perf_counter()
+    for text in messages:
+        func(text)
+    return (time.perf_counter() - start) / len(messages)
+
+def main():
+    rng = random.Random(42)
+    print(f"{'handles':>8} {'matcher, мкс/сообщ.':>22} {'цикл подстрок, мкс/сообщ.':>28}")
+    for count in HANDLE_COUNTS:
+        handles = [random_handle(rng) for _ in range(count)]
+        messages = make_messages(rng, handles, MESSAGES)
+        matcher = MentionMatcher(handles)
+        per_message = bench(matcher.match, messages)
+        legacy = bench(lambda text: legacy_match(handles, text), messages[:LEGACY_MESSAGES])
+        print(f"{count:>8} {per_message * 1e6:>22.2f} {legacy * 1e6:>28.2f}")
+
+if __name__ == "__main__":
+    main()
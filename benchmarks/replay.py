@@ -0,0 +1,232 @@
+# Офлайн-бенчмарк обработки сообщений: синтетические события Telethon
+# прогоняются через фильтр ChatScope, handle_new_message и отправитель уведомлений
+# с заглушкой вместо Bot API. Сеть и настоящие ключи не нужны.
+#
+# Примеры:
+#   python benchmarks/replay.py --users 1000 --messages 20000 --chats 50
+#   python benchmarks/replay.py --rate 500 --mention-density 0.2
+#   python benchmarks/replay.py --replay capture.jsonl
+#   python benchmarks/replay.py --replay capture.jsonl --handles tracked.txt
+#
+# События проходят тот же путь, что и в main(): фильтр ChatScope, обработчик
+# make_account_handler (распределение чатов между аккаунтами) и mark_handled.
+# Не моделируются только сам клиент Telethon и догоняющее чтение.
+#
+# Формат записи (JSONL), одна строка на сообщение:
+#   {"chat_id": -1001234567890, "text": "привет @someone", "chat_title": "Группа", "message_id": 42}
+# Необязательное поле "tracked" — список отслеживаемых ников. Без --handles и "tracked"
+# отслеживаемыми считаются все @упоминания из записи.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import string
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telethon.tl.custom.message import Message
+from telethon.tl.types import Channel, PeerChannel
+
+import bot
+from accounts import Account, AccountPool
+from chat_scope import ChatScope
+from matcher import HANDLE_RE
+from metrics import metrics
+from notifier import NotificationDispatcher
+from storage import CheckpointStore
+from subscriptions import SubscriptionStore
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+WORDS = ["привет", "когда", "релиз", "hello", "ok", "посмотри", "тут", "spam", "завтра", "deploy"]
+
+class StubBot:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+class ReplayEvent:
+    # Минимальный набор атрибутов NewMessage.Event, который использует бот
+    def __init__(self, message, chat):
+        self.message = message
+        self.chat = chat
+        self.chat_id = message.chat_id
+        self.sender = None
+
+    @property
+    def raw_text(self):
+        return self.message.message
+
+    async def get_chat(self):
+        await asyncio.sleep(0)
+        return self.chat
+
+def make_chat(chat_id, title):
+    channel_id = int(str(chat_id).replace("-100", "", 1)) if str(chat_id).startswith("-100") else abs(chat_id)
+    return Channel(id=channel_id, title=title, photo=None, date=None, megagroup=True)
+
+def make_event(message_id, text, chat):
+    message = Message(id=message_id, peer_id=PeerChannel(chat.id), message=text, date=None)
+    return ReplayEvent(message, chat)
+
+def random_handle(rng):
+    return "@" + "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(5, 16)))
+
+def synthetic_events(args, handles):
+    rng = random.Random(args.seed)
+    chats = [make_chat(-1000000000000 - i, f"Чат {i}") for i in range(1, args.chats + 1)]
+    for message_id in range(1, args.messages + 1):
+        chat = chats[rng.randrange(len(chats))]
+        words = []
+        while sum(len(word) + 1 for word in words) < args.text_size:
+            words.append(rng.choice(WORDS))
+        if rng.random() < args.mention_density:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(handles))
+        elif rng.random() < args.mention_density:
+            words.insert(rng.randrange(len(words) + 1), random_handle(rng))
+        yield make_event(message_id, " ".join(words), chat)
+
+def load_capture(path):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                record = json.loads(line)
+                record.setdefault("message_id", line_number)
+                records.append(record)
+    return records
+
+def replay_events(records):
+    chats = {}
+    for record in records:
+        chat_id = int(record["chat_id"])
+        chat = chats.get(chat_id)
+        if chat is None:
+            chat = chats[chat_id] = make_chat(chat_id, record.get("chat_title", str(chat_id)))
+        yield make_event(int(record["message_id"]), record.get("text", ""), chat)
+
+def load_handles(path):
+    with open(path, encoding="utf-8") as f:
+        return ["@" + line.strip().lstrip("@") for line in f if line.strip()]
+
+def capture_handles(records):
+    # Ники из поля "tracked", а если его нет ни в одной записи — все упоминания из текстов
+    tracked = {"@" + handle.lstrip("@") for record in records for handle in record.get("tracked") or ()}
+    if tracked:
+        return sorted(tracked)
+    return sorted({"@" + handle for record in records for handle in HANDLE_RE.findall(record.get("text", ""))})
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # На Linux ru_maxrss в килобайтах, на macOS в байтах
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+async def run(args):
+    rng = random.Random(args.seed)
+    records = load_capture(args.replay) if args.replay else None
+    if args.handles:
+        handles = load_handles(args.handles)
+    elif records is not None:
+        handles = capture_handles(records)
+    else:
+        handles = [random_handle(rng) for _ in range(args.users)]
+    if not handles:
+        sys.exit("Нет отслеживаемых ников: укажите --handles или поле \"tracked\" в записи")
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.subscriptions = SubscriptionStore(os.path.join(tmp, "subscriptions.db"))
+        bot.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints.json"))
+        for subscriber_id in range(1, args.subscribers + 1):
+            bot.subscriptions.import_handles(subscriber_id, rng.sample(handles, max(1, len(handles) // args.subscribers)))
+        try:
+            await replay(args, handles, records)
+        finally:
+            bot.subscriptions.close()
+
+async def replay(args, handles, records):
+    stub_bot = StubBot(args.send_latency)
+    dispatcher = NotificationDispatcher(stub_bot, queue_size=args.queue_size, per_chat_interval=0, global_rate=1e9)
+    dispatcher.start()
+    scope = ChatScope()
+    account = Account("main", None)
+    pool = AccountPool([account])
+    handler = bot.make_account_handler(account, pool, lambda event: bot.handle_new_message(event, dispatcher))
+
+    def on_filtered(event):
+        bot.mark_handled(account, event)
+
+    events = list(replay_events(records) if records is not None else synthetic_events(args, handles))
+    latencies = []
+    loop = asyncio.get_running_loop()
+    interval = 1.0 / args.rate if args.rate else 0.0
+    started = loop.time()
+    for index, event in enumerate(events):
+        scheduled = started + index * interval
+        if interval:
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            scheduled = loop.time()
+        if scope.accepts(event, on_filtered):
+            await handler(event)
+        latencies.append(loop.time() - scheduled)
+    elapsed = loop.time() - started
+    await dispatcher.stop(timeout=60)
+
+    latencies.sort()
+    print(f"Сообщений: {len(events)}, отслеживаемых пользователей: {len(handles)}, подписчиков: {args.subscribers}")
+    print(f"Пропускная способность: {len(events) / elapsed:.0f} сообщ./с за {elapsed:.2f} с")
+    print(
+        "Задержка на сообщение: "
+        f"p50={percentile(latencies, 0.5) * 1e6:.1f} мкс "
+        f"p95={percentile(latencies, 0.95) * 1e6:.1f} мкс "
+        f"p99={percentile(latencies, 0.99) * 1e6:.1f} мкс "
+        f"max={latencies[-1] * 1e6 if latencies else 0:.1f} мкс"
+    )
+    print(f"Уведомлений отправлено: {stub_bot.sent}, отброшено: {dispatcher.dropped}")
+    print(f"Контрольных точек: {len(bot.checkpoints)}, событий у аккаунта: {account.events}")
+    rss = peak_rss_mb()
+    print(f"Пиковый RSS: {f'{rss:.1f} МБ' if rss is not None else 'н/д'}")
+    if args.metrics:
+        print(metrics.render_text())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработки сообщений")
+    parser.add_argument("--users", type=int, default=100, help="число отслеживаемых пользователей")
+    parser.add_argument("--messages", type=int, default=10000, help="число синтетических сообщений")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду, 0 — без ограничения")
+    parser.add_argument("--text-size", type=int, default=120, help="длина текста сообщения в символах")
+    parser.add_argument("--mention-density", type=float, default=0.05, help="доля сообщений с упоминанием")
+    parser.add_argument("--chats", type=int, default=20, help="число чатов")
+    parser.add_argument("--subscribers", type=int, default=1, help="число чатов-подписчиков")
+    parser.add_argument("--replay", help="JSONL-файл с записанным трафиком вместо синтетики")
+    parser.add_argument("--handles", help="файл с отслеживаемыми никами, по одному на строку")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="имитация задержки Bot API, с")
+    parser.add_argument("--queue-size", type=int, default=100000, help="размер очереди уведомлений")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--metrics", action="store_true", help="вывести метрики бота после прогона")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(run(parse_args()))
@@ -1,11 +1,20 @@
+import time
+# Отсчет времени запуска, включая импорт зависимостей
+STARTED_AT = time.perf_counter()
+
 import os
 import json
 import logging
 import asyncio
-from telethon.sync import TelegramClient
+import secrets
+import signal
+import zlib
+from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.events import NewMessage
-from telethon.tl.types import PeerChannel, PeerChat
+from telethon.errors import FloodWaitError
+from telethon.events import ChatAction, MessageEdited, NewMessage
+from telethon.tl.types import MessageEntityMention, MessageEntityMentionName, PeerChannel
+from telethon.utils import resolve_id
 from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, ConversationHandler, MessageHandler,
@@ -13,8 +22,17 @@ from telegram.ext import (
 )
 from dotenv import load_dotenv
 
-# Настройка логирования
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+from accounts import AccountPool
+from chat_cache import ChatInfoCache, DialogCache
+from chat_scope import CHAT_TYPES, ChatScope
+from dedup import NotificationDeduplicator
+from metrics import metrics, start_metrics_server
+from logging_setup import message_logger, redacting_filter, setup_logging
+from notifier import Notification, NotificationDispatcher
+from outbox import Outbox
+from storage import CheckpointStore, atomic_write_json
+from subscriptions import SubscriptionStore
+
 logger = logging.getLogger(__name__)
 
 # Состояния
@@ -22,9 +40,20 @@ STATE_API_ID, STATE_API_HASH, STATE_PHONE, STATE_CODE, STATE_PASSWORD, STATE_ADD
 
 CONFIG_FILE = "config.json"
 TRACKED_USERS_FILE = "tracked_users.json"
+SUBSCRIPTIONS_DB = "subscriptions.db"
+CHECKPOINTS_FILE = "checkpoints.json"
+OUTBOX_FILE = "outbox.db"
 load_dotenv()
 
-def load_config():
+def get_setting(config, key, default=None):
+    value = config.get(key)
+    if value is None:
+        value = os.getenv(key, default)
+    return value
+
+_config_cache = None
+
+def read_config():
     logger.debug("Попытка загрузки конфигурации из %s", CONFIG_FILE)
     if os.path.exists(CONFIG_FILE):
         try:
@@ -36,20 +65,30 @@ def load_config():
             logger.error("Ошибка при загрузке конфигурации: %s", e)
     return {}
 
+def load_config():
+    # Файл читается один раз, дальше команды получают копию из памяти.
+    # Копия нужна, чтобы изменения без save_config не попадали в кэш.
+    global _config_cache
+    if _config_cache is None:
+        _config_cache = read_config()
+    return dict(_config_cache)
+
 def save_config(config):
+    global _config_cache
     logger.debug("Сохранение конфигурации: %s", config)
     try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        atomic_write_json(CONFIG_FILE, config)
         logger.info("Конфигурация сохранена в %s", CONFIG_FILE)
     except Exception as e:
         logger.error("Ошибка при сохранении конфигурации: %s", e)
+    finally:
+        _config_cache = None
 
-def load_tracked_users():
-    logger.debug("Попытка загрузки отслеживаемых пользователей из %s", TRACKED_USERS_FILE)
-    if os.path.exists(TRACKED_USERS_FILE):
+def load_tracked_users(path=TRACKED_USERS_FILE):
+    logger.debug("Попытка загрузки отслеживаемых пользователей из %s", path)
+    if os.path.exists(path):
         try:
-            with open(TRACKED_USERS_FILE, 'r') as f:
+            with open(path, 'r') as f:
                 users = json.load(f)
                 logger.debug("Отслеживаемые пользователи: %s", users)
                 return users
@@ -57,14 +96,25 @@ def load_tracked_users():
             logger.error("Ошибка при загрузке отслеживаемых пользователей: %s", e)
     return []
 
-def save_tracked_users(users):
-    logger.debug("Сохранение отслеживаемых пользователей: %s", users)
+def import_legacy_tracked_users(admin_id, path=TRACKED_USERS_FILE):
+    # Первый запуск после перехода на SQLite: старый общий список становится
+    # подпиской администратора. Файл переименовывается, чтобы импорт не повторялся,
+    # когда подписчиков снова не останется.
+    if not os.path.exists(path):
+        return
+    if not subscriptions.subscribers():
+        subscriptions.import_handles(admin_id, load_tracked_users(path))
     try:
-        with open(TRACKED_USERS_FILE, 'w') as f:
-            json.dump(users, f, indent=4)
-        logger.info("Отслеживаемые пользователи сохранены в %s", TRACKED_USERS_FILE)
-    except Exception as e:
-        logger.error("Ошибка при сохранении отслеживаемых пользователей: %s", e)
+        os.replace(path, path + ".imported")
+        logger.info("Список %s перенесен в базу подписок", path)
+    except OSError as e:
+        logger.error("Не удалось переименовать %s: %s", path, e)
+
+subscriptions = SubscriptionStore(SUBSCRIPTIONS_DB)
+chat_cache = ChatInfoCache()
+dialog_cache = DialogCache(chat_cache=chat_cache)
+deduplicator = NotificationDeduplicator()
+checkpoints = CheckpointStore(CHECKPOINTS_FILE)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Команда /start вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
@@ -81,8 +131,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     /setup - Настроить бота
     /adduser - Добавить пользователя для отслеживания
     /removeuser - Удалить пользователя из списка отслеживания
+    /myscope - Выбрать чаты, из которых приходят уведомления
+    /subscribers - Управлять чатами-подписчиками
     /status - Проверить статус бота
     /chats - Просмотреть доступные чаты
+    /scope - Настроить, какие чаты мониторить
+    /stats - Показать метрики производительности
+    /outbox - Показать очередь неотправленных уведомлений
     /testmention - Протестировать уведомления
     /ping - Проверить активность бота
     /reset - Сбросить настройки
@@ -157,6 +212,7 @@ async def get_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await client.sign_in(phone=phone, code=code, phone_code_hash=phone_code_hash, password=password)
         session_string = client.session.save()
+        redacting_filter.add_secret(session_string)
         config = load_config()
         config.update({
             "API_ID": context.user_data['api_id'],
@@ -189,11 +245,18 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Pong! Бот активен.")
     return ConversationHandler.END
 
+def can_manage_subscription(update, config):
+    # Администратор управляет подписками в любом чате, остальные — только
+    # в чатах, которые администратор добавил в подписчики
+    if str(update.message.from_user.id) == config.get("ADMIN_ID"):
+        return True
+    return subscriptions.is_subscriber(update.message.chat_id)
+
 async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Команда /adduser вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
     config = load_config()
-    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
-        await update.message.reply_text("Только администратор может добавлять пользователей.")
+    if not can_manage_subscription(update, config):
+        await update.message.reply_text("Этот чат не подписан на уведомления. Обратитесь к администратору.")
         return ConversationHandler.END
     await update.message.reply_text("Введите имя пользователя для добавления (с @):")
     return STATE_ADD_USER
@@ -202,11 +265,10 @@ async def get_user_to_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.text.strip()
     if not username.startswith('@'):
         username = f"@{username}"
-    logger.debug("Добавление пользователя: %s", username)
-    tracked_users = load_tracked_users()
-    if username not in tracked_users:
-        tracked_users.append(username)
-        save_tracked_users(tracked_users)
+    subscriber_id = update.message.chat_id
+    logger.debug("Добавление пользователя %s для чата %s", username, subscriber_id)
+    subscriptions.add_subscriber(subscriber_id)
+    if subscriptions.add(subscriber_id, username):
         await update.message.reply_text(f"Пользователь {username} добавлен в список отслеживания.")
     else:
         await update.message.reply_text(f"Пользователь {username} уже в списке отслеживания.")
@@ -215,8 +277,8 @@ async def get_user_to_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Команда /removeuser вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
     config = load_config()
-    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
-        await update.message.reply_text("Только администратор может удалять пользователей.")
+    if not can_manage_subscription(update, config):
+        await update.message.reply_text("Этот чат не подписан на уведомления. Обратитесь к администратору.")
         return ConversationHandler.END
     await update.message.reply_text("Введите имя пользователя для удаления (с @):")
     return STATE_REMOVE_USER
@@ -225,24 +287,58 @@ async def get_user_to_remove(update: Update, context: ContextTypes.DEFAULT_TYPE)
     username = update.message.text.strip()
     if not username.startswith('@'):
         username = f"@{username}"
-    logger.debug("Удаление пользователя: %s", username)
-    tracked_users = load_tracked_users()
-    if username in tracked_users:
-        tracked_users.remove(username)
-        save_tracked_users(tracked_users)
+    subscriber_id = update.message.chat_id
+    logger.debug("Удаление пользователя %s для чата %s", username, subscriber_id)
+    if subscriptions.remove(subscriber_id, username):
         await update.message.reply_text(f"Пользователь {username} удален из списка отслеживания.")
     else:
         await update.message.reply_text(f"Пользователь {username} не найден в списке отслеживания.")
     return ConversationHandler.END
 
+async def subscribers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Команда /subscribers вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
+    config = load_config()
+    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
+        await update.message.reply_text("Только администратор может управлять подписчиками.")
+        return
+    args = context.args or []
+    if len(args) == 2 and args[0].lower() in ("add", "remove"):
+        try:
+            chat_id = int(args[1])
+        except ValueError:
+            await update.message.reply_text("ID чата должен быть числом.")
+            return
+        if args[0].lower() == "add":
+            added = subscriptions.add_subscriber(chat_id)
+            await update.message.reply_text(f"Чат {chat_id} {'добавлен в подписчики' if added else 'уже подписан'}.")
+        else:
+            removed = subscriptions.remove_subscriber(chat_id)
+            await update.message.reply_text(f"Чат {chat_id} {'удален из подписчиков' if removed else 'не найден'}.")
+        return
+    if args:
+        await update.message.reply_text("Использование: /subscribers [add|remove <id чата>]")
+        return
+    lines = [
+        f"{chat_id}: {', '.join(subscriptions.handles_for(chat_id)) or 'нет пользователей'}"
+        for chat_id in subscriptions.subscribers()
+    ]
+    await update.message.reply_text("Подписчики:\n" + ("\n".join(lines) if lines else "Нет"))
+
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Команда /status вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
     config = load_config()
-    tracked_users = load_tracked_users()
+    tracked_users = subscriptions.handles_for(update.message.chat_id)
     status_text = "Статус бота:\n"
     status_text += f"Конфигурация: {'Полная' if all(key in config for key in ['API_ID', 'API_HASH', 'SESSION_STRING', 'ADMIN_ID']) else 'Неполная'}\n"
     status_text += f"Отслеживаемые пользователи: {', '.join(tracked_users) if tracked_users else 'Нет'}\n"
+    status_text += f"Подписчиков: {len(subscriptions.subscribers())}, всего отслеживаемых пользователей: {subscriptions.handle_count}\n"
     status_text += "Бот мониторит чаты через Telethon клиент.\n"
+    pool = context.bot_data.get("accounts")
+    if pool:
+        status_text += f"Аккаунты ({len(pool)}):\n{pool.describe()}\n"
+    pipeline = context.bot_data.get("pipeline")
+    if pipeline:
+        status_text += f"Конвейер:\n{pipeline.describe()}\n"
     try:
         chat_member = await context.bot.get_chat_member(update.message.chat_id, context.bot.id)
         status_text += f"Права бота в текущем чате: {chat_member.status}\n"
@@ -252,6 +348,15 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status_text += f"Ошибка проверки прав: {str(e)}\n"
     await update.message.reply_text(status_text)
 
+DIALOG_FILTERS = {
+    "all": None,
+    "groups": {"group", "megagroup"},
+    "channels": {"channel"},
+    "private": {"private", "bot"},
+}
+DEFAULT_DIALOG_TYPES = {"group", "megagroup", "channel"}
+CHATS_PAGE_SIZE = 50
+
 async def list_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Команда /chats вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
     config = load_config()
@@ -261,27 +366,69 @@ async def list_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if str(update.message.from_user.id) != config.get("ADMIN_ID"):
         await update.message.reply_text("Только администратор может просматривать чаты.")
         return
-    api_id = int(config["API_ID"])
-    api_hash = config["API_HASH"]
-    session_string = config["SESSION_STRING"]
-    try:
-        client = TelegramClient(StringSession(session_string), api_id, api_hash)
-        await client.connect()
-        if not await client.is_user_authorized():
-            await update.message.reply_text("Сессия не авторизована. Пожалуйста, выполните /setup заново.")
+    if context.bot_data.get("pipeline"):
+        # Сессия уже подключена в процессе приема, второе подключение с тем же
+        # ключом авторизации Telegram разрывает
+        await update.message.reply_text(
+            "В режиме конвейера (PIPELINE_WORKERS) /chats недоступна: аккаунт подключен в отдельном процессе приема."
+        )
+        return
+
+    # /chats [all|groups|channels|private] [страница]
+    types = DEFAULT_DIALOG_TYPES
+    page = 1
+    for arg in context.args or []:
+        if arg.isdigit():
+            page = max(int(arg), 1)
+        elif arg.lower() in DIALOG_FILTERS:
+            types = DIALOG_FILTERS[arg.lower()]
+        else:
+            await update.message.reply_text(
+                f"Использование: /chats [{'|'.join(DIALOG_FILTERS)}] [страница]"
+            )
             return
 
-        chats = []
-        async for dialog in client.iter_dialogs():
-            if isinstance(dialog.entity, (PeerChannel, PeerChat)):  # Только группы и каналы
-                chats.append(f"{dialog.name} (ID: {dialog.id})")
+    # Используем уже подключенный клиент мониторинга. Временный клиент нужен
+    # только если мониторинг еще не запущен (например, сразу после /setup).
+    # Пока клиент мониторинга переподключается, второе подключение той же сессии
+    # Telegram разорвал бы, поэтому отвечаем из кэша диалогов.
+    client = context.bot_data.get("telethon_client")
+    temporary_client = None
+    header = "Чаты, доступные Telethon клиенту"
+    try:
+        if client is None:
+            temporary_client = client = TelegramClient(
+                StringSession(config["SESSION_STRING"]), int(config["API_ID"]), config["API_HASH"]
+            )
+            await client.connect()
+            if not await client.is_user_authorized():
+                await update.message.reply_text("Сессия не авторизована. Пожалуйста, выполните /setup заново.")
+                return
+
+        if client.is_connected():
+            dialogs = await dialog_cache.get(client)
+        else:
+            dialogs = dialog_cache.entries()
+            if not dialogs:
+                await update.message.reply_text("Telethon клиент переподключается, попробуйте позже.")
+                return
+            header += " (из кэша, клиент переподключается)"
+        chats = [
+            f"{info.title} (ID: {info.chat_id}, {info.type})"
+            for info in dialogs
+            if types is None or info.type in types
+        ]
 
         if not chats:
-            await update.message.reply_text("Нет доступных групп или каналов. Подпишитесь на них через ваш аккаунт.")
+            await update.message.reply_text("Нет доступных чатов этого типа. Подпишитесь на них через ваш аккаунт.")
             return
 
+        pages = (len(chats) + CHATS_PAGE_SIZE - 1) // CHATS_PAGE_SIZE
+        page = min(page, pages)
+        chats = chats[(page - 1) * CHATS_PAGE_SIZE:page * CHATS_PAGE_SIZE]
+
         # Разбиваем на сообщения по 4000 символов
-        message = "Чаты, доступные Telethon клиенту:\n"
+        message = f"{header} (страница {page}/{pages}):\n"
         messages = []
         for chat in chats:
             if len(message) + len(chat) + 1 > 4000:
@@ -296,46 +443,472 @@ async def list_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error("Ошибка при получении списка чатов: %s", e)
         await update.message.reply_text(f"Ошибка: {str(e)}")
     finally:
-        await client.disconnect()
+        if temporary_client:
+            await temporary_client.disconnect()
+
+def is_channel_id(chat_id):
+    return resolve_id(chat_id)[1] is PeerChannel
+
+def checkpoint_key(account, chat_id):
+    # У каналов и супергрупп id сообщений общие для всех аккаунтов, а в обычных
+    # группах и личных чатах у каждого аккаунта своя нумерация
+    if is_channel_id(chat_id):
+        return chat_id
+    return f"{account.name}:{chat_id}"
+
+def mark_handled(account, event):
+    checkpoints.update(checkpoint_key(account, event.chat_id), event.message.id)
+
+def subscribe_new_messages(account, scope, pool=None):
+    # Пересоздаем фильтры NewMessage и MessageEdited, чтобы Telethon отбрасывал лишние чаты до вызова обработчика.
+    # Отброшенные события отмечает только владелец чата: остальные аккаунты
+    # не знают, обработал ли владелец предыдущие сообщения.
+    def on_filtered(event):
+        if pool is None or pool.owns(account, event.chat_id):
+            mark_handled(account, event)
+
+    account.scope = scope
+    account.client.remove_event_handler(account.handler)
+    for event_builder in scope.message_events(on_filtered=on_filtered):
+        account.client.add_event_handler(account.handler, event_builder)
+    logger.info("Подписка на сообщения обновлена:\n%s", scope.describe())
+
+def scope_usage(command):
+    return (
+        "Использование:\n"
+        f"/{command} - показать настройки\n"
+        f"/{command} allow <id> - только разрешенные чаты\n"
+        f"/{command} deny <id> - исключить чат\n"
+        f"/{command} remove <id> - убрать чат из обоих списков\n"
+        f"/{command} types <тип ...> | all - типы чатов: {', '.join(CHAT_TYPES)}\n"
+        "ID чатов можно узнать через /chats."
+    )
+
+def apply_scope_args(scope, args, command):
+    # Меняет scope по аргументам команды, возвращает текст ошибки или None
+    action, values = args[0].lower(), args[1:]
+    if action in ("allow", "deny", "remove") and values:
+        try:
+            chat_ids = [int(value) for value in values]
+        except ValueError:
+            return "ID чата должен быть числом."
+        for chat_id in chat_ids:
+            scope.allow.discard(chat_id)
+            scope.deny.discard(chat_id)
+            if action == "allow":
+                scope.allow.add(chat_id)
+            elif action == "deny":
+                scope.deny.add(chat_id)
+    elif action == "types" and values:
+        types = {value.lower() for value in values}
+        if types == {"all"}:
+            types = set()
+        unknown = types - set(CHAT_TYPES)
+        if unknown:
+            return f"Неизвестные типы чатов: {', '.join(sorted(unknown))}"
+        scope.types = types
+    else:
+        return scope_usage(command)
+    return None
+
+async def chat_scope(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Команда /scope вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
+    config = load_config()
+    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
+        await update.message.reply_text("Только администратор может настраивать мониторинг чатов.")
+        return
+    scope = ChatScope.from_config(config)
+    args = context.args or []
+    if not args:
+        await update.message.reply_text("Настройки мониторинга:\n" + scope.describe() + "\n" + scope_usage("scope"))
+        return
+    error = apply_scope_args(scope, args, "scope")
+    if error:
+        await update.message.reply_text(error)
+        return
+
+    config["CHAT_SCOPE"] = scope.to_config()
+    save_config(config)
+    pool = context.bot_data.get("accounts")
+    if pool:
+        for account in pool.accounts:
+            subscribe_new_messages(account, scope, pool)
+    pipeline = context.bot_data.get("pipeline")
+    if pipeline:
+        pipeline.update_scope(scope.to_config())
+    await update.message.reply_text("Настройки мониторинга обновлены:\n" + scope.describe())
+
+async def my_scope(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Команда /myscope вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
+    config = load_config()
+    subscriber_id = update.message.chat_id
+    if not can_manage_subscription(update, config) or not subscriptions.is_subscriber(subscriber_id):
+        await update.message.reply_text("Этот чат не подписан на уведомления. Обратитесь к администратору.")
+        return
+    # Область подписчика сужает общую область мониторинга: уведомления приходят
+    # только из выбранных чатов
+    scope = subscriptions.get_scope(subscriber_id)
+    args = context.args or []
+    if not args:
+        await update.message.reply_text("Уведомления для этого чата:\n" + scope.describe() + "\n" + scope_usage("myscope"))
+        return
+    error = apply_scope_args(scope, args, "myscope")
+    if error:
+        await update.message.reply_text(error)
+        return
+    subscriptions.set_scope(subscriber_id, scope)
+    await update.message.reply_text("Настройки уведомлений обновлены:\n" + scope.describe())
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Команда /stats вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
+    config = load_config()
+    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
+        await update.message.reply_text("Только администратор может просматривать метрики.")
+        return
+    await update.message.reply_text("Метрики бота:\n" + metrics.render_text())
+
+async def outbox_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Команда /outbox вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
+    config = load_config()
+    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
+        await update.message.reply_text("Только администратор может просматривать очередь уведомлений.")
+        return
+    outbox = context.bot_data.get("outbox")
+    if outbox is None:
+        await update.message.reply_text("Outbox не запущен.")
+        return
+    oldest_age = outbox.oldest_age()
+    dispatcher = context.bot_data.get("dispatcher")
+    lines = [
+        f"Неотправленных уведомлений: {len(outbox)}",
+        f"Самое старое: {f'{oldest_age:.0f} с назад' if oldest_age is not None else 'нет'}",
+    ]
+    if dispatcher:
+        lines.append(f"В очереди отправки: {dispatcher.depth}, ожидают повторной доставки: {dispatcher.redelivering}")
+    await update.message.reply_text("\n".join(lines))
 
 async def test_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Команда /testmention вызвана пользователем %s в чате %s", update.message.from_user.id, update.message.chat_id)
     config = load_config()
-    if str(update.message.from_user.id) != config.get("ADMIN_ID"):
-        await update.message.reply_text("Только администратор может тестировать уведомления.")
+    if not can_manage_subscription(update, config):
+        await update.message.reply_text("Этот чат не подписан на уведомления. Обратитесь к администратору.")
         return
-    tracked_users = load_tracked_users()
+    tracked_users = subscriptions.handles_for(update.message.chat_id)
     if not tracked_users:
         await update.message.reply_text("Список отслеживаемых пользователей пуст. Добавьте пользователей через /adduser.")
         return
     try:
         await context.bot.send_message(
-            chat_id=config["ADMIN_ID"],
+            chat_id=update.message.chat_id,
             text=f"Тестовое уведомление: Пользователь {tracked_users[0]} упомянут (тест)."
         )
-        await update.message.reply_text("Тестовое уведомление отправлено. Проверьте личный чат с ботом.")
+        await update.message.reply_text("Тестовое уведомление отправлено.")
     except Exception as e:
         logger.error("Ошибка при отправке тестового уведомления: %s", e)
         await update.message.reply_text(f"Ошибка при отправке тестового уведомления: {str(e)}")
 
-async def handle_new_message(event, bot, admin_id):
-    logger.debug("Получено сообщение в чате %s: %s", event.chat_id, event.raw_text)
-    tracked_users = load_tracked_users()
-    message_text = event.raw_text.lower() if event.raw_text else ""
+def extract_mentions(message):
+    # Упоминания, которые Telegram уже разметил сущностями. Смещения сущностей
+    # заданы в UTF-16, поэтому текст берем через get_entities_text.
+    if not message.entities:
+        return None, None
+    mention_texts = []
+    mention_user_ids = []
+    for entity in message.entities:
+        if isinstance(entity, MessageEntityMentionName):
+            mention_user_ids.append(entity.user_id)
+    if any(isinstance(entity, MessageEntityMention) for entity in message.entities):
+        mention_texts = [text for _, text in message.get_entities_text(MessageEntityMention)]
+    return mention_texts, mention_user_ids
 
-    for user in tracked_users:
-        if user.lower() in message_text:
-            try:
-                chat = await event.get_chat()
-                chat_name = getattr(chat, 'title', 'Личный чат')
-                message_link = f"https://t.me/c/{str(chat.id).replace('-100', '')}/{event.message.id}"
-                await bot.send_message(
-                    chat_id=admin_id,
-                    text=f"Пользователь {user} упомянут в чате '{chat_name}': {message_link}"
-                )
-                logger.info("Уведомление отправлено админу %s о пользователе %s в чате %s (%s)", admin_id, user, chat.id, chat_name)
-            except Exception as e:
-                logger.error("Ошибка при отправке уведомления: %s", e)
+def message_key(message, chat_id):
+    # Ключ сообщения для дедупликации между аккаунтами: в обычных группах
+    # и личных чатах id сообщения у каждого аккаунта свой. Отправитель и секунда
+    # не уникальны, поэтому добавляем crc32 текста (hash() строк в каждом процессе свой)
+    if is_channel_id(chat_id) or message.date is None:
+        return message.id
+    return (message.sender_id, int(message.date.timestamp()), zlib.crc32((message.message or "").encode()))
+
+def fan_out(dispatcher, users, chat_id, chat_title, chat_type, message_link):
+    # Рассылаем только подписчикам, которые отслеживают найденных пользователей
+    # и чья область мониторинга включает этот чат
+    for user in users:
+        for subscriber_id in subscriptions.subscribers_for(user, chat_id, chat_type):
+            dispatcher.submit(Notification(subscriber_id, user, chat_title, message_link))
+            logger.info("Уведомление для чата %s о пользователе %s в чате %s (%s) поставлено в очередь", subscriber_id, user, chat_id, chat_title)
+
+async def handle_new_message(event, dispatcher):
+    message_logger.debug("Получено сообщение в чате %s: %.200s", event.chat_id, event.raw_text)
+    matcher = subscriptions.current_matcher()
+    sender = event.sender
+    if sender is not None:
+        matcher.remember_user_id(sender.id, getattr(sender, 'username', None))
+    start = time.perf_counter()
+    mention_texts, mention_user_ids = extract_mentions(event.message)
+    matched_users = matcher.match(event.raw_text, mention_texts, mention_user_ids)
+    metrics.observe("match_seconds", time.perf_counter() - start)
+
+    if not matched_users:
+        return
+    # Для отредактированных сообщений это оставляет только новые упоминания
+    matched_users = deduplicator.filter_new(event.chat_id, message_key(event.message, event.chat_id), event.raw_text, matched_users)
+    if not matched_users:
+        metrics.inc("notifications_deduplicated")
+        return
+
+    # Данные чата нужны один раз на сообщение и обычно уже есть в кэше
+    try:
+        chat_info = await chat_cache.resolve(event)
+    except Exception as e:
+        logger.error("Ошибка при получении данных чата %s: %s", event.chat_id, e)
+        return
+    message_link = chat_info.message_link(event.message.id)
+    metrics.inc("messages_matched")
+    fan_out(dispatcher, matched_users, chat_info.chat_id, chat_info.title, chat_info.type, message_link)
+
+async def catch_up_chat(client, process_event, scope, key, chat_id, min_id, limit, semaphore):
+    # Читаем сообщения новее контрольной точки от старых к новым и сдвигаем точку
+    # после обработки каждого, поэтому падение посреди чтения ничего не теряет.
+    # После FloodWait продолжаем с того места, где остановились.
+    processed = 0
+    try:
+        async with semaphore:
+            for attempt in range(3):
+                try:
+                    # Одно сообщение сверх лимита показывает, что лимит обрезал чтение
+                    async for message in client.iter_messages(chat_id, min_id=min_id, reverse=True, limit=limit - processed + 1):
+                        if processed >= limit:
+                            metrics.inc("catch_up_truncated")
+                            logger.warning("Чат %s: пропущено больше %d сообщений, сообщения новее %d не будут прочитаны",
+                                           chat_id, limit, min_id)
+                            break
+                        event = NewMessage.Event(message)
+                        event._set_client(client)
+                        if scope.accepts(event):
+                            await process_event(event)
+                        checkpoints.progress(key, message.id)
+                        min_id = message.id
+                        processed += 1
+                    return processed
+                except FloodWaitError as e:
+                    logger.warning("FloodWait при догоняющем чтении чата %s, ждем %d с", chat_id, e.seconds)
+                    await asyncio.sleep(e.seconds)
+                except Exception as e:
+                    logger.error("Ошибка при догоняющем чтении чата %s: %s", chat_id, e)
+                    return processed
+        return processed
+    finally:
+        checkpoints.release(key)
+
+async def catch_up(account, pool, process_event, scope, saved_checkpoints, concurrency=4, limit=500):
+    # Догоняем сообщения, пропущенные пока бот был остановлен. Контрольные точки
+    # берутся на момент запуска, до первых живых событий. Живые события приходят
+    # параллельно, повторы отсекает окно дедупликации.
+    start = time.perf_counter()
+    chats = []
+    for key, last_id in saved_checkpoints:
+        name, _, chat_id = str(key).rpartition(":")
+        chat_id = int(chat_id)
+        if name in ("", account.name) and scope.allows_chat(chat_id) and pool.owns(account, chat_id):
+            chats.append((key, chat_id, last_id))
+    if not chats:
+        return
+    logger.info("Аккаунт %s: догоняющее чтение %d чатов", account.name, len(chats))
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = await asyncio.gather(*(
+        catch_up_chat(account.client, process_event, scope, key, chat_id, last_id, limit, semaphore)
+        for key, chat_id, last_id in chats
+    ))
+    metrics.inc("catch_up_messages", sum(counts))
+    logger.info("Аккаунт %s: догоняющее чтение завершено, %d сообщений за %.2f с",
+                account.name, sum(counts), time.perf_counter() - start)
+
+async def start_monitoring(pool, process_event, scope, saved_checkpoints, concurrency, limit, rebalance_interval):
+    # Списки диалогов нужны для разбиения чатов между аккаунтами и заполняют
+    # кэш сущностей, без которого iter_messages по id не работает.
+    # Заодно /chats сразу отвечает из памяти.
+    try:
+        results = await asyncio.gather(
+            *(account.dialogs.get(account.client) for account in pool.accounts),
+            return_exceptions=True,
+        )
+        for account, result in zip(pool.accounts, results):
+            if isinstance(result, Exception):
+                logger.error("Аккаунт %s: ошибка при загрузке диалогов: %s", account.name, result)
+        pool.rebalance()
+        await asyncio.gather(*(
+            catch_up(account, pool, process_event, scope, saved_checkpoints, concurrency, limit)
+            for account in pool.accounts
+        ))
+    finally:
+        # Чаты, которые не догонялись (вне области или без доступа), отпускаем тоже
+        checkpoints.release_all()
+    await watch_accounts(pool, process_event, limit, rebalance_interval)
+
+async def watch_accounts(pool, process_event, limit, interval=30.0):
+    # Перераспределяем чаты, когда аккаунт отключился или снова подключился
+    # и когда меняются списки диалогов. Новый владелец догоняет сообщения
+    # с контрольной точки канала, пропущенные пока чат был ничей.
+    balanced_state = pool.state()
+    semaphore = asyncio.Semaphore(1)
+    while True:
+        await asyncio.sleep(interval)
+        for account in pool.accounts:
+            if account.connected:
+                try:
+                    await account.dialogs.get(account.client)
+                except Exception as e:
+                    logger.error("Аккаунт %s: ошибка при обновлении диалогов: %s", account.name, e)
+        state = pool.state()
+        if state == balanced_state:
+            continue
+        balanced_state = state
+        moved = pool.rebalance()
+        for chat_id, owner_name in moved.items():
+            owner = pool.account(owner_name)
+            last_id = checkpoints.get(chat_id)
+            if is_channel_id(chat_id) and last_id and owner.scope is not None:
+                checkpoints.hold(chat_id)
+                task = asyncio.create_task(catch_up_chat(
+                    owner.client, process_event, owner.scope, chat_id, chat_id, last_id, limit, semaphore,
+                ))
+                pool.catch_up_tasks.add(task)
+                task.add_done_callback(pool.catch_up_tasks.discard)
+
+first_event_logged = False
+
+def make_account_handler(account, pool, process_event):
+    async def handler(event):
+        global first_event_logged
+        account.record_event()
+        if not pool.owns(account, event.chat_id):
+            account.skipped += 1
+            return
+        # Правки сообщений, обработанных до перезапуска, не уведомляют повторно:
+        # окно дедупликации после перезапуска пустое
+        if isinstance(event, MessageEdited.Event):
+            startup_checkpoint = pool.startup_checkpoints.get(checkpoint_key(account, event.chat_id), 0)
+            if event.message.id <= startup_checkpoint:
+                metrics.inc("edits_skipped")
+                return
+        if not first_event_logged:
+            first_event_logged = True
+            logger.info("Первое сообщение из отслеживаемых чатов получено через %.3f с после запуска процесса",
+                        time.perf_counter() - STARTED_AT)
+        await process_event(event)
+        mark_handled(account, event)
+    return handler
+
+def create_telethon_pool(config, process_event):
+    # Создает клиенты всех аккаунтов и подписывает их на сообщения, не подключаясь.
+    # process_event получает каждое событие, прошедшее фильтр области мониторинга.
+    # Пул возвращается до первого await, чтобы остановка всегда могла отключить клиенты.
+    pool = AccountPool.from_config(config, primary_dialogs=dialog_cache)
+    scope = ChatScope.from_config(config)
+
+    async def chat_action_handler(event):
+        if event.new_title:
+            chat_cache.invalidate(event.chat_id)
+            for account in pool.accounts:
+                account.dialogs.rename(event.chat_id, event.new_title)
+
+    for account in pool.accounts:
+        logger.info("Инициализация Telethon клиента %s", account.name)
+        redacting_filter.add_secret(account.session_string)
+        account.client = TelegramClient(StringSession(account.session_string), int(config["API_ID"]), config["API_HASH"])
+        account.handler = make_account_handler(account, pool, process_event)
+        subscribe_new_messages(account, scope, pool)
+        account.client.add_event_handler(chat_action_handler, ChatAction())
+    return pool
+
+async def start_telethon(pool, config, process_event):
+    checkpoints.load()
+    # Старые точки обычных групп и личных чатов без аккаунта в ключе
+    # записывал основной аккаунт
+    for key, _ in checkpoints.items():
+        if isinstance(key, int) and not is_channel_id(key):
+            checkpoints.migrate(key, checkpoint_key(pool.primary, key))
+    saved_checkpoints = checkpoints.items()
+    pool.startup_checkpoints = dict(saved_checkpoints)
+    # До окончания догоняющего чтения живые события не сдвигают сохраненные точки
+    for key, _ in saved_checkpoints:
+        checkpoints.hold(key)
+
+    await asyncio.gather(*(account.client.start() for account in pool.accounts))
+    logger.info("Telethon клиенты запущены: %d", len(pool))
+    checkpoints.start()
+    pool.monitoring = asyncio.create_task(start_monitoring(
+        pool, process_event, pool.primary.scope, saved_checkpoints,
+        concurrency=int(get_setting(config, "CATCH_UP_CONCURRENCY", 4)),
+        limit=int(get_setting(config, "CATCH_UP_LIMIT", 500)),
+        rebalance_interval=float(get_setting(config, "REBALANCE_INTERVAL", 30)),
+    ))
+
+async def stop_telethon(pool):
+    logger.info("Остановка Telethon клиентов")
+    tasks = list(pool.catch_up_tasks)
+    if pool.monitoring is not None:
+        tasks.append(pool.monitoring)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for account in pool.accounts:
+        if account.client:
+            await account.client.disconnect()
+    await checkpoints.stop()
+
+def install_shutdown_handlers(stop_event):
+    # SIGTERM от systemd/docker и Ctrl+C будят main сразу, без опроса в цикле
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: SIGINT по-прежнему прерывает asyncio.run через KeyboardInterrupt
+            pass
+
+def create_webhook_server(application, config):
+    from webhook import WebhookServer
+
+    # Секрет генерируется на каждый запуск, если не задан: webhook все равно
+    # регистрируется заново при старте
+    secret_token = get_setting(config, "WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    redacting_filter.add_secret(secret_token)
+    path = "/" + get_setting(config, "WEBHOOK_PATH", "telegram").strip("/")
+    return WebhookServer(application, path, secret_token)
+
+async def start_webhook(server, config):
+    await server.start(get_setting(config, "WEBHOOK_HOST", "0.0.0.0"), int(get_setting(config, "WEBHOOK_PORT", 8443)))
+    await server.application.bot.set_webhook(
+        get_setting(config, "WEBHOOK_URL").rstrip("/") + server.path,
+        secret_token=server.secret_token,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True,
+    )
+
+async def run_together(*coroutines):
+    # Первая ошибка отменяет остальные задачи, и исключение уходит дальше только
+    # после их завершения: очистка в finally видит все, что успело запуститься
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+def notify_matches(result, dispatcher):
+    # Результат обработчика конвейера: дедупликация и рассылка общие для всех процессов
+    chat_id, message_key, text, users, chat_title, chat_type, message_link = result
+    users = deduplicator.filter_new(chat_id, message_key, text, users)
+    if not users:
+        metrics.inc("notifications_deduplicated")
+        return
+    metrics.inc("messages_matched")
+    fan_out(dispatcher, users, chat_id, chat_title, chat_type, message_link)
 
 async def main():
     logger.info("Запуск бота")
@@ -345,16 +918,31 @@ async def main():
     api_hash = config.get("API_HASH")
     session_string = config.get("SESSION_STRING")
     admin_id = config.get("ADMIN_ID")
+    for secret in (bot_token, api_hash, session_string):
+        redacting_filter.add_secret(secret)
 
     if not bot_token:
         logger.error("BOT_TOKEN не указан в config.json или .env. Бот не может запуститься.")
         return
 
     application = None
-    client = None
+    webhook_server = None
+    pool = None
+    pipeline = None
+    dispatcher = None
+    outbox = None
+    consume_task = None
+    metrics_server = None
+    stop_event = asyncio.Event()
+    install_shutdown_handlers(stop_event)
     try:
         logger.info("Инициализация Application с BOT_TOKEN")
-        application = Application.builder().token(bot_token).build()
+        builder = Application.builder().token(bot_token)
+        bot_api_url = get_setting(config, "BOT_API_URL")
+        if bot_api_url:
+            # Локальный Bot API сервер или его имитация для тестов
+            builder = builder.base_url(bot_api_url.rstrip("/") + "/bot")
+        application = builder.build()
 
         # Добавление обработчиков команд
         conv_handler = ConversationHandler(
@@ -381,52 +969,145 @@ async def main():
         application.add_handler(CommandHandler("ping", ping))
         application.add_handler(CommandHandler("status", status))
         application.add_handler(CommandHandler("chats", list_chats))
+        application.add_handler(CommandHandler("scope", chat_scope))
+        application.add_handler(CommandHandler("myscope", my_scope))
+        application.add_handler(CommandHandler("subscribers", subscribers))
+        application.add_handler(CommandHandler("stats", stats))
+        application.add_handler(CommandHandler("outbox", outbox_status))
         application.add_handler(CommandHandler("testmention", test_mention))
         application.add_handler(conv_handler)
 
-        logger.info("Запуск polling")
-        await application.initialize()
-        await application.start()
-        await application.updater.start_polling(drop_pending_updates=True)
-        logger.info("Бот успешно запущен и ожидает команды")
+        # Упоминания сначала попадают в outbox на диске, неотправленные
+        # в прошлый раз уведомления доставляются заново
+        outbox = Outbox(OUTBOX_FILE, float(get_setting(config, "OUTBOX_COMMIT_INTERVAL", 0.2)))
+        pending_notifications = outbox.load()
+        outbox.start()
+        # Отправитель запускается после подключения к Bot API, а найденные
+        # до этого упоминания ждут в очереди
+        dispatcher = NotificationDispatcher(
+            application.bot,
+            digest_window=float(get_setting(config, "DIGEST_WINDOW", 0)),
+            outbox=outbox,
+        )
+        application.bot_data["outbox"] = outbox
+        application.bot_data["dispatcher"] = dispatcher
+        deduplicator.by_content = str(get_setting(config, "DEDUP_BY_CONTENT", "false")).lower() in ("1", "true", "yes")
+        metrics.gauge("dedup_entries", lambda: len(deduplicator))
+        metrics.gauge("chat_cache_size", lambda: len(chat_cache))
+
+        metrics_port = get_setting(config, "METRICS_PORT")
+        if metrics_port:
+            metrics_server = await start_metrics_server(
+                get_setting(config, "METRICS_HOST", "127.0.0.1"), int(metrics_port)
+            )
+
+        # Подключения к Bot API и MTProto устанавливаются параллельно
+        timings = {"импорт и конфигурация": time.perf_counter() - STARTED_AT}
+
+        async def start_bot_api():
+            nonlocal webhook_server
+            phase_start = time.perf_counter()
+            await application.initialize()
+            await application.start()
+            if get_setting(config, "WEBHOOK_URL"):
+                logger.info("Запуск webhook")
+                webhook_server = create_webhook_server(application, config)
+                await start_webhook(webhook_server, config)
+            else:
+                logger.info("Запуск polling")
+                await application.updater.start_polling(drop_pending_updates=True)
+            timings["Bot API"] = time.perf_counter() - phase_start
+            logger.info("Бот успешно запущен и ожидает команды")
+
+        async def start_mtproto():
+            nonlocal pool, pipeline
+            phase_start = time.perf_counter()
+            subscriptions.reload()
+            import_legacy_tracked_users(int(admin_id))
+            pipeline_workers = int(get_setting(config, "PIPELINE_WORKERS", 0))
+            if pipeline_workers > 0:
+                from pipeline import Pipeline
+
+                # Конвейер: прием в отдельном процессе, сопоставление в пуле процессов,
+                # отправка здесь, рядом с обработчиками команд
+                pipeline = Pipeline(pipeline_workers, int(get_setting(config, "PIPELINE_QUEUE_SIZE", 10000)))
+                pipeline.start(get_setting(config, "LOG_LEVEL", "INFO"), SUBSCRIPTIONS_DB)
+                application.bot_data["pipeline"] = pipeline
+                timings["запуск конвейера"] = time.perf_counter() - phase_start
+            else:
+                async def process_event(event):
+                    await handle_new_message(event, dispatcher)
+
+                pool = create_telethon_pool(config, process_event)
+                await start_telethon(pool, config, process_event)
+                application.bot_data["telethon_client"] = pool.primary.client
+                application.bot_data["accounts"] = pool
+                timings["MTProto"] = time.perf_counter() - phase_start
 
         # Запуск Telethon клиента, если конфигурация полная
         if all([api_id, api_hash, session_string, admin_id]):
-            logger.info("Инициализация Telethon клиента")
-            client = TelegramClient(StringSession(session_string), int(api_id), api_hash)
-
-            @client.on(NewMessage(chats=None))  # Мониторить все доступные чаты
-            async def handler(event):
-                await handle_new_message(event, application.bot, admin_id)
-
-            async with client:
-                await client.start()
-                logger.info("Telethon клиент запущен")
-                while application.updater.running:
-                    await asyncio.sleep(1)
+            await run_together(start_bot_api(), start_mtproto())
         else:
+            await start_bot_api()
             logger.info("Конфигурация не полная, ожидание команд /setup")
-            while application.updater.running:
-                await asyncio.sleep(1)
+        dispatcher.start()
+        asyncio.create_task(dispatcher.replay(pending_notifications))
+        if pipeline:
+            consume_task = asyncio.create_task(pipeline.consume(lambda result: notify_matches(result, dispatcher)))
+        timings["всего"] = time.perf_counter() - STARTED_AT
+        logger.info("Время запуска: %s", ", ".join(f"{name} {seconds:.3f} с" for name, seconds in timings.items()))
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки")
 
     except Exception as e:
         logger.error("Ошибка в главном цикле: %s", e)
         if admin_id and application:
-            await application.bot.send_message(
-                chat_id=admin_id,
-                text=f"Произошла ошибка при запуске бота: {str(e)}"
-            )
+            try:
+                await application.bot.send_message(
+                    chat_id=admin_id,
+                    text=f"Произошла ошибка при запуске бота: {str(e)}"
+                )
+            except Exception as send_error:
+                # Bot API недоступен (например, неверный токен), очистка ниже важнее
+                logger.error("Не удалось сообщить администратору об ошибке: %s", send_error)
     finally:
+        # Сначала перестаем принимать новые события, затем дожидаемся отправки
+        # уже найденных упоминаний, и только после этого закрываем Bot API
+        shutdown_start = time.perf_counter()
+        if metrics_server:
+            metrics_server.close()
+        if webhook_server:
+            await webhook_server.stop()
         if application and application.updater.running:
-            logger.info("Остановка Application")
             await application.updater.stop()
-            await application.stop()
+        if pool:
+            await stop_telethon(pool)
+        if pipeline:
+            await pipeline.stop()
+            if consume_task:
+                await consume_task
+        if dispatcher:
+            logger.info("Отправка оставшихся уведомлений")
+            await dispatcher.stop(float(get_setting(config, "SHUTDOWN_TIMEOUT", 10)))
+        if outbox:
+            await outbox.stop()
+        if application:
+            if application.running:
+                logger.info("Остановка Application")
+                await application.stop()
+            # Закрывает HTTP-клиент Bot API и после неудачного запуска; без initialize ничего не делает
             await application.shutdown()
             logger.info("Application полностью остановлен")
-        if client:
-            logger.info("Остановка Telethon клиента")
-            await client.disconnect()
+        logger.info("Бот остановлен за %.3f с", time.perf_counter() - shutdown_start)
 
 if __name__ == "__main__":
     import asyncio
-    asyncio.run(main())
+    startup_config = load_config()
+    log_listener = setup_logging(
+        get_setting(startup_config, "LOG_LEVEL", "INFO"),
+        get_setting(startup_config, "LOG_MESSAGE_RATE", 5),
+    )
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
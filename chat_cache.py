@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.types import Channel, Chat, User
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Запас на расхождение часов с сервером Telegram при инкрементальном обновлении диалогов
+DIALOG_REFRESH_OVERLAP = timedelta(seconds=60)
+
+@dataclass(frozen=True)
+class ChatInfo:
+    chat_id: int
+    title: str
+    link_prefix: str
+    type: str
+
+    def message_link(self, message_id):
+        return f"{self.link_prefix}/{message_id}"
+
+def chat_type(chat):
+    if isinstance(chat, Channel):
+        return "megagroup" if chat.megagroup else "channel"
+    if isinstance(chat, Chat):
+        return "group"
+    if isinstance(chat, User):
+        return "bot" if chat.bot else "private"
+    return "unknown"
+
+def chat_info_from_entity(chat_id, chat):
+    return ChatInfo(
+        chat_id=chat_id,
+        title=getattr(chat, 'title', 'Личный чат'),
+        link_prefix=f"https://t.me/c/{str(chat.id).replace('-100', '')}",
+        type=chat_type(chat),
+    )
+
+class ChatInfoCache:
+    # LRU-кэш метаданных чатов с ограниченным размером и временем жизни записи.
+    # Сетевой запрос get_chat нужен только для первого сообщения из чата.
+
+    def __init__(self, max_size=5000, ttl=3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_cached(self, chat_id):
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        info, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[chat_id]
+            return None
+        self._entries.move_to_end(chat_id)
+        return info
+
+    def put(self, info):
+        self._entries[info.chat_id] = (info, time.monotonic() + self.ttl)
+        self._entries.move_to_end(info.chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        if self._entries.pop(chat_id, None) is not None:
+            logger.debug("Метаданные чата %s сброшены", chat_id)
+
+    async def resolve(self, event):
+        info = self.get_cached(event.chat_id)
+        if info is not None:
+            metrics.inc("chat_cache_hits")
+            return info
+        metrics.inc("chat_cache_misses")
+        with metrics.timer("get_chat_seconds"):
+            chat = await event.get_chat()
+        info = chat_info_from_entity(event.chat_id, chat)
+        self.put(info)
+        return info
+
+class DialogCache:
+    # Список диалогов аккаунта для /chats. Первый раз загружается полностью,
+    # дальше обновляются только диалоги с новыми сообщениями: iter_dialogs отдает
+    # их по убыванию даты последнего сообщения, поэтому обход останавливается
+    # на первом диалоге старше прошлого обновления.
+
+    def __init__(self, refresh_interval=60.0, full_refresh_interval=3600.0, chat_cache=None):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.chat_cache = chat_cache
+        self._entries = OrderedDict()
+        self._refreshed_at = None
+        self._refreshed_at_wall = None
+        self._full_refreshed_at = None
+        self._lock = asyncio.Lock()
+
+    def _entry(self, dialog):
+        info = replace(chat_info_from_entity(dialog.id, dialog.entity), title=dialog.name)
+        if self.chat_cache is not None and info.type not in ("private", "bot"):
+            self.chat_cache.put(info)
+        return info
+
+    async def get(self, client):
+        async with self._lock:
+            now = time.monotonic()
+            if self._full_refreshed_at is None or now - self._full_refreshed_at > self.full_refresh_interval:
+                await self._full_refresh(client)
+            elif now - self._refreshed_at > self.refresh_interval:
+                await self._incremental_refresh(client)
+            return list(self._entries.values())
+
+    async def _full_refresh(self, client):
+        started_at = datetime.now(timezone.utc) - DIALOG_REFRESH_OVERLAP
+        entries = OrderedDict()
+        async for dialog in client.iter_dialogs():
+            entries[dialog.id] = self._entry(dialog)
+        self._entries = entries
+        self._refreshed_at = self._full_refreshed_at = time.monotonic()
+        self._refreshed_at_wall = started_at
+        logger.info("Список диалогов загружен полностью: %d", len(entries))
+
+    async def _incremental_refresh(self, client):
+        started_at = datetime.now(timezone.utc) - DIALOG_REFRESH_OVERLAP
+        fresh = OrderedDict()
+        async for dialog in client.iter_dialogs():
+            # Закрепленные диалоги идут первыми независимо от даты, по ним
+            # нельзя судить, что дальше только старые
+            if dialog.pinned:
+                fresh[dialog.id] = self._entry(dialog)
+                continue
+            if dialog.date and dialog.date < self._refreshed_at_wall:
+                break
+            fresh[dialog.id] = self._entry(dialog)
+        for chat_id, info in self._entries.items():
+            fresh.setdefault(chat_id, info)
+        self._entries = fresh
+        self._refreshed_at = time.monotonic()
+        self._refreshed_at_wall = started_at
+        logger.debug("Список диалогов обновлен")
+
+    def entries(self):
+        return list(self._entries.values())
+
+    def rename(self, chat_id, title):
+        info = self._entries.get(chat_id)
+        if info is not None:
+            self._entries[chat_id] = replace(info, title=title)
@@ -0,0 +1,98 @@
+from telethon.events import MessageEdited, NewMessage
+from telethon.tl.types import MessageEntityMention, MessageEntityMentionName, PeerChat, PeerUser
+
+from chat_cache import chat_type
+from metrics import metrics
+
+CHAT_TYPES = ("private", "bot", "group", "megagroup", "channel")
+MENTION_ENTITIES = (MessageEntityMention, MessageEntityMentionName)
+
+def has_possible_mention(message):
+    # Дешевая проверка до любого разбора текста: без '@' и без сущностей-упоминаний
+    # в сообщении не может быть упоминания отслеживаемого пользователя
+    if message.message and '@' in message.message:
+        return True
+    if message.entities:
+        return any(isinstance(entity, MENTION_ENTITIES) for entity in message.entities)
+    return False
+
+def event_chat_type(event):
+    # Тип чата без сетевых запросов: по сущности из апдейта, а если ее нет — по типу peer
+    chat = event.chat
+    if chat is not None:
+        return chat_type(chat)
+    peer = event.message.peer_id
+    if isinstance(peer, PeerUser):
+        return "private"
+    if isinstance(peer, PeerChat):
+        return "group"
+    return None
+
+class ChatScope:
+    # Какие чаты мониторить: белый и черный списки по id и допустимые типы чатов.
+    # Хранится в config.json под ключом CHAT_SCOPE.
+
+    def __init__(self, allow=(), deny=(), types=()):
+        self.allow = set(int(chat_id) for chat_id in allow)
+        self.deny = set(int(chat_id) for chat_id in deny)
+        self.types = set(types)
+
+    @classmethod
+    def from_config(cls, config):
+        scope = config.get("CHAT_SCOPE") or {}
+        return cls(scope.get("allow", ()), scope.get("deny", ()), scope.get("types", ()))
+
+    def to_config(self):
+        return {
+            "allow": sorted(self.allow),
+            "deny": sorted(self.deny),
+            "types": sorted(self.types),
+        }
+
+    def allows_chat(self, chat_id):
+        if chat_id in self.deny:
+            return False
+        return not self.allow or chat_id in self.allow
+
+    def allows(self, chat_id, kind):
+        if not self.allows_chat(chat_id):
+            return False
+        return not self.types or kind not in CHAT_TYPES or kind in self.types
+
+    def accepts(self, event, on_filtered=None):
+        # on_filtered вызывается для отброшенных событий: их обработка на этом
+        # закончена, и контрольную точку можно сдвигать сразу
+        metrics.inc("events_received")
+        if not has_possible_mention(event.message):
+            metrics.inc("events_filtered")
+            if on_filtered is not None:
+                on_filtered(event)
+            return False
+        if self.types:
+            kind = event_chat_type(event)
+            # Неизвестный тип (канал без сущности в апдейте) не отбрасываем
+            if kind is not None and kind not in self.types:
+                metrics.inc("events_filtered")
+                if on_filtered is not None:
+                    on_filtered(event)
+                return False
+        return True
+
+    def message_event(self, event_class=NewMessage, on_filtered=None):
+        func = lambda event: self.accepts(event, on_filtered)
+        if self.allow:
+            return event_class(chats=sorted(self.allow - self.deny), func=func)
+        if self.deny:
+            return event_class(chats=sorted(self.deny), blacklist_chats=True, func=func)
+        return event_class(func=func)
+
+    def message_events(self, on_filtered=None):
+        # Новые и отредактированные сообщения фильтруются одинаково
+        return [self.message_event(NewMessage, on_filtered), self.message_event(MessageEdited, on_filtered)]
+
+    def describe(self):
+        return (
+            f"Разрешенные чаты: {', '.join(map(str, sorted(self.allow))) or 'все'}\n"
+            f"Исключенные чаты: {', '.join(map(str, sorted(self.deny))) or 'нет'}\n"
+            f"Типы чатов: {', '.join(sorted(self.types)) or 'все'}\n"
+        )
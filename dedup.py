@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+
+class DedupWindow:
+    # Множество недавно увиденных ключей с ограничением по размеру и времени жизни.
+    # Старые ключи вытесняются первыми, поэтому память не растет со временем работы.
+
+    def __init__(self, max_size=50000, ttl=24 * 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return False
+        return True
+
+    def add(self, key, value=None):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def check_and_add(self, key):
+        # True, если ключ уже встречался в окне
+        if key in self:
+            return True
+        self.add(key)
+        return False
+
+    def setdefault(self, key, value):
+        # Значение, с которым ключ впервые попал в окно
+        if key in self:
+            return self._entries[key][1]
+        self.add(key, value)
+        return value
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and expires_at >= now:
+                break
+            del self._entries[key]
+
+class NotificationDeduplicator:
+    # Одно уведомление на (чат, сообщение, пользователь). Дополнительно можно
+    # склеивать одинаковый текст в разных чатах: пересылки и повторы спам-ботов.
+    # Одинаковые сообщения разных людей в одном чате при этом не склеиваются.
+
+    def __init__(self, max_size=50000, ttl=24 * 3600.0, by_content=False, content_ttl=600.0):
+        self.by_content = by_content
+        self._messages = DedupWindow(max_size, ttl)
+        self._contents = DedupWindow(max_size, content_ttl)
+
+    def __len__(self):
+        return len(self._messages) + len(self._contents)
+
+    def filter_new(self, chat_id, message_id, text, users):
+        fresh = []
+        content_hash = hash(text) if self.by_content and text else None
+        for user in users:
+            if self._messages.check_and_add((chat_id, message_id, user)):
+                continue
+            if content_hash is not None and self._contents.setdefault((content_hash, user), chat_id) != chat_id:
+                continue
+            fresh.append(user)
+        return fresh
@@ -0,0 +1,109 @@
+import logging
+import logging.handlers
+import queue
+import re
+import time
+from collections.abc import Mapping
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+SECRET_KEYS = ("SESSION_STRING", "API_HASH", "BOT_TOKEN")
+REDACTED = "***"
+BOT_TOKEN_RE = re.compile(r'\d{6,}:[A-Za-z0-9_-]{30,}')
+
+# Отдельный логгер для строк, которые пишутся на каждое входящее сообщение
+message_logger = logging.getLogger("bot.messages")
+
+class RedactingFilter(logging.Filter):
+    # Убирает секреты из аргументов записи до того, как она будет отформатирована
+
+    def __init__(self):
+        super().__init__()
+        self._secrets = set()
+
+    def add_secret(self, value):
+        if value:
+            self._secrets.add(str(value))
+
+    def _redact_text(self, text):
+        for secret in self._secrets:
+            if secret in text:
+                text = text.replace(secret, REDACTED)
+        return BOT_TOKEN_RE.sub(REDACTED, text)
+
+    def _redact(self, value):
+        if isinstance(value, str):
+            return self._redact_text(value)
+        if isinstance(value, Mapping):
+            return {
+                key: REDACTED if key in SECRET_KEYS and item else self._redact(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, (list, tuple)):
+            return [self._redact(item) for item in value]
+        if isinstance(value, BaseException):
+            return self._redact_text(str(value))
+        return value
+
+    def filter(self, record):
+        if isinstance(record.msg, str):
+            record.msg = self._redact_text(record.msg)
+        if isinstance(record.args, Mapping):
+            record.args = self._redact(record.args)
+        elif record.args:
+            record.args = tuple(self._redact(arg) for arg in record.args)
+        return True
+
+class RateLimitFilter(logging.Filter):
+    # Пропускает не больше rate записей в секунду, остальные считает и отбрасывает
+
+    def __init__(self, rate=5):
+        super().__init__()
+        self.rate = rate
+        self._window = 0
+        self._count = 0
+        self._suppressed = 0
+
+    def filter(self, record):
+        window = int(time.monotonic())
+        if window != self._window:
+            self._window = window
+            self._count = 0
+        if self._count >= self.rate:
+            self._suppressed += 1
+            return False
+        self._count += 1
+        if self._suppressed:
+            record.msg = f"[пропущено {self._suppressed}] {record.msg}"
+            self._suppressed = 0
+        return True
+
+redacting_filter = RedactingFilter()
+
+def setup_logging(level="INFO", message_rate=5):
+    # Запись в stderr выполняется в отдельном потоке QueueListener,
+    # event loop только кладет запись в очередь
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(redacting_filter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    set_log_level(level)
+
+    message_logger.filters.clear()
+    message_logger.addFilter(RateLimitFilter(int(message_rate)))
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def set_log_level(level):
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    logging.getLogger().setLevel(level)
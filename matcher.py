@@ -0,0 +1,64 @@
+import re
+
+# Имя пользователя Telegram: латиница, цифры и подчеркивание.
+# Упоминание не должно быть продолжением другого слова или e-mail адреса,
+# а жадный квантификатор гарантирует, что @bob не совпадет внутри @bobby.
+HANDLE_RE = re.compile(r'(?<![A-Za-z0-9_@])@([A-Za-z0-9_]+)')
+
+def normalize_handle(handle):
+    return handle.strip().lstrip('@').lower()
+
+class MentionMatcher:
+    # Строится один раз при изменении списка отслеживаемых пользователей.
+    # Поиск идет одним проходом по тексту: каждое найденное упоминание
+    # проверяется по словарю, поэтому стоимость не зависит от числа пользователей.
+
+    def __init__(self, handles, known_ids=None):
+        self._index = {}
+        for handle in handles:
+            key = normalize_handle(handle)
+            if key:
+                self._index.setdefault(key, handle)
+        self._by_id = {}
+        for user_id, key in (known_ids or {}).items():
+            if key in self._index:
+                self._by_id[user_id] = key
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def known_ids(self):
+        return dict(self._by_id)
+
+    def remember_user_id(self, user_id, username):
+        # MessageEntityMentionName содержит только user_id, поэтому запоминаем
+        # id отслеживаемых пользователей, когда видим их с username
+        if not username or user_id in self._by_id:
+            return
+        key = normalize_handle(username)
+        if key in self._index:
+            self._by_id[user_id] = key
+
+    def match(self, text, mention_texts=None, mention_user_ids=None):
+        # mention_texts и mention_user_ids берутся из сущностей сообщения.
+        # Если Telegram уже разметил упоминания, текст не сканируется.
+        found = []
+        if mention_texts or mention_user_ids:
+            for mention in mention_texts or ():
+                self._add(found, normalize_handle(mention))
+            for user_id in mention_user_ids or ():
+                key = self._by_id.get(user_id)
+                if key:
+                    self._add(found, key)
+            return found
+        if not text or '@' not in text:
+            return found
+        for match in HANDLE_RE.finditer(text):
+            self._add(found, match.group(1).lower())
+        return found
+
+    def _add(self, found, key):
+        handle = self._index.get(key)
+        if handle is not None and handle not in found:
+            found.append(handle)
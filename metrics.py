@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "autopinggbot_"
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+class Histogram:
+    # Гистограмма с фиксированными корзинами: память не растет,
+    # а перцентили оцениваются интерполяцией внутри корзины
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.sum += other.sum
+        self.count += other.count
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started_at = time.monotonic()
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def take(self):
+        # Счетчики и гистограммы с момента прошлого вызова. Дочерние процессы конвейера
+        # периодически отправляют их в основной процесс, где они прибавляются через merge
+        snapshot = (self.counters, self.histograms)
+        self.counters = {}
+        self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, histograms = snapshot
+        for name, value in counters.items():
+            self.inc(name, value)
+        for name, other in histograms.items():
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(other.buckets)
+            histogram.merge(other)
+
+    def gauge(self, name, func):
+        # Значение вычисляется в момент чтения, например длина очереди
+        self.gauges[name] = func
+
+    def _gauge_values(self):
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                logger.debug("Не удалось получить метрику %s: %s", name, e)
+        return values
+
+    def render_text(self):
+        lines = [f"Время работы: {time.monotonic() - self.started_at:.0f} с"]
+        for name in sorted(self.counters):
+            lines.append(f"{name}: {self.counters[name]}")
+        for name, value in sorted(self._gauge_values().items()):
+            lines.append(f"{name}: {value}")
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            lines.append(
+                f"{name}: n={histogram.count} "
+                f"p50={histogram.quantile(0.5) * 1000:.2f} мс "
+                f"p95={histogram.quantile(0.95) * 1000:.2f} мс "
+                f"p99={histogram.quantile(0.99) * 1000:.2f} мс"
+            )
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        lines = []
+        for name in sorted(self.counters):
+            metric = f"{METRICS_PREFIX}{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {self.counters[name]}")
+        for name, value in sorted(self._gauge_values().items()):
+            metric = f"{METRICS_PREFIX}{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            metric = f"{METRICS_PREFIX}{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны, просто дочитываем их
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render_prometheus()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug("Ошибка при обработке запроса метрик: %s", e)
+    finally:
+        writer.close()
+
+async def start_metrics_server(host, port):
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("Метрики доступны по адресу http://%s:%s/metrics", host, port)
+    return server
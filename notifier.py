@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Bot API: около 1 сообщения в секунду в один чат и 30 сообщений в секунду всего
+PER_CHAT_INTERVAL = 1.0
+GLOBAL_RATE = 30
+MAX_MESSAGE_LENGTH = 4000
+# Повторная доставка уведомлений из outbox, если все попытки отправки исчерпаны
+REDELIVERY_BASE_DELAY = 5.0
+REDELIVERY_MAX_DELAY = 600.0
+
+@dataclass
+class Notification:
+    chat_id: int
+    user: str
+    chat_name: str
+    link: str
+    outbox_id: int = field(default=None, compare=False)
+    attempts: int = field(default=0, compare=False)
+
+    @property
+    def text(self):
+        return f"Пользователь {self.user} упомянут в чате '{self.chat_name}': {self.link}"
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+def render_digest(notifications):
+    # Группируем упоминания по (чат, пользователь) и собираем одно сообщение на получателя,
+    # разбивая его на части, если оно не влезает в лимит длины
+    by_recipient = OrderedDict()
+    for notification in notifications:
+        groups = by_recipient.setdefault(notification.chat_id, OrderedDict())
+        groups.setdefault((notification.chat_name, notification.user), []).append(notification.link)
+
+    messages = []
+    for chat_id, groups in by_recipient.items():
+        if len(groups) == 1:
+            links = next(iter(groups.values()))
+            if len(links) == 1:
+                (chat_name, user), = groups.keys()
+                messages.append((chat_id, Notification(chat_id, user, chat_name, links[0]).text))
+                continue
+        message = "Сводка упоминаний:\n"
+        for (chat_name, user), links in groups.items():
+            line = f"{user} в чате '{chat_name}' ({len(links)}): {', '.join(links)}\n"
+            if len(message) + len(line) > MAX_MESSAGE_LENGTH:
+                messages.append((chat_id, message))
+                message = "Продолжение:\n"
+            message += line
+        messages.append((chat_id, message))
+    return messages
+
+class NotificationDispatcher:
+    # Очередь исходящих уведомлений и отдельная задача-отправитель.
+    # Обработчик Telethon только кладет уведомление в очередь и никогда не ждет отправки.
+    # С outbox уведомление сначала записывается на диск и удаляется оттуда только
+    # после доставки, поэтому переполнение очереди и сбои сети его не теряют.
+    # У каждого чата-получателя своя очередь и своя задача отправки: пауза между
+    # сообщениями в один чат не задерживает остальных, общий лимит Bot API делится между всеми.
+
+    def __init__(self, bot, queue_size=1000, digest_window=0.0, max_retries=5,
+                 per_chat_interval=PER_CHAT_INTERVAL, global_rate=GLOBAL_RATE, outbox=None):
+        self.bot = bot
+        self.outbox = outbox
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1.0 / global_rate
+        self.dropped = 0
+        # Лимит считается до доставки, а не до выемки из очереди: уведомление
+        # занимает место, пока лежит в очереди своего чата или отправляется
+        self.queue_size = queue_size
+        self._pending = 0
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._queue = asyncio.Queue()
+        self._chat_ready_at = {}
+        self._global_ready_at = 0.0
+        self._task = None
+        self._chats = {}
+        self._workers = {}
+        self._redelivery = set()
+        metrics.gauge("notification_queue_depth", lambda: self.depth)
+
+    @property
+    def depth(self):
+        return self._pending
+
+    @property
+    def redelivering(self):
+        return len(self._redelivery)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Отправитель уведомлений запущен (режим сводки: %s)",
+                        f"{self.digest_window} с" if self.digest_window else "выключен")
+
+    async def stop(self, timeout=10.0):
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не удалось отправить %d уведомлений до остановки", self.depth)
+        for handle in self._redelivery:
+            handle.cancel()
+        self._redelivery.clear()
+        for worker in list(self._workers.values()):
+            worker.cancel()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def submit(self, notification):
+        if self.outbox is not None and notification.outbox_id is None:
+            self.outbox.add(notification)
+        if self._pending < self.queue_size:
+            self._queue.put_nowait(notification)
+            self._pending += 1
+            if self._pending >= self.queue_size:
+                self._has_space.clear()
+            return True
+        if notification.outbox_id is not None:
+            metrics.inc("notifications_deferred")
+            logger.warning("Очередь уведомлений переполнена, уведомление о %s отложено в outbox", notification.user)
+            self._redeliver([notification])
+            return True
+        self.dropped += 1
+        metrics.inc("notifications_dropped")
+        logger.error("Очередь уведомлений переполнена, уведомление о %s отброшено", notification.user)
+        return False
+
+    async def replay(self, notifications):
+        # Уведомления из outbox, оставшиеся после прошлого запуска
+        for notification in notifications:
+            while self._pending >= self.queue_size:
+                await self._has_space.wait()
+            self.submit(notification)
+        if notifications:
+            logger.info("Повторно поставлено в очередь уведомлений из outbox: %d", len(notifications))
+
+    def _redeliver(self, notifications):
+        # Экспоненциальная задержка перед следующей попыткой доставки
+        attempts = max(notification.attempts for notification in notifications) + 1
+        delay = min(REDELIVERY_BASE_DELAY * 2 ** (attempts - 1), REDELIVERY_MAX_DELAY)
+        for notification in notifications:
+            notification.attempts = attempts
+        loop = asyncio.get_running_loop()
+        handle = None
+
+        def requeue():
+            self._redelivery.discard(handle)
+            for notification in notifications:
+                self.submit(notification)
+
+        handle = loop.call_later(delay, requeue)
+        self._redelivery.add(handle)
+        logger.info("Повторная доставка %d уведомлений через %.0f с", len(notifications), delay)
+
+    async def _deliver(self, messages, notifications):
+        for chat_id, text in messages:
+            sent = await self._send(chat_id, text)
+            if sent is None and self.outbox is not None:
+                self._redeliver(notifications)
+                return
+            if not sent:
+                break
+        # Доставленные и окончательно отклоненные Bot API уведомления из outbox удаляются
+        if self.outbox is not None:
+            self.outbox.ack(notifications)
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        if self.digest_window:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.digest_window
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                if self.digest_window:
+                    by_recipient = OrderedDict()
+                    for notification in batch:
+                        by_recipient.setdefault(notification.chat_id, []).append(notification)
+                    deliveries = [(render_digest(group), group) for group in by_recipient.values()]
+                else:
+                    deliveries = [([(notification.chat_id, notification.text)], [notification]) for notification in batch]
+            except Exception as e:
+                logger.error("Ошибка в отправителе уведомлений: %s", e)
+                self._done(len(batch))
+                continue
+            for messages, notifications in deliveries:
+                self._enqueue(messages, notifications)
+
+    def _done(self, count):
+        for _ in range(count):
+            self._queue.task_done()
+        self._pending -= count
+        if self._pending < self.queue_size:
+            self._has_space.set()
+
+    def _enqueue(self, messages, notifications):
+        chat_id = notifications[0].chat_id
+        self._chats.setdefault(chat_id, deque()).append((messages, notifications))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id))
+
+    async def _chat_worker(self, chat_id):
+        # Отправляет накопившееся для одного чата и завершается, когда очередь чата пуста
+        pending = self._chats[chat_id]
+        try:
+            while pending:
+                messages, notifications = pending.popleft()
+                try:
+                    await self._deliver(messages, notifications)
+                except Exception as e:
+                    logger.error("Ошибка в отправителе уведомлений: %s", e)
+                finally:
+                    self._done(len(notifications))
+        finally:
+            del self._chats[chat_id]
+            del self._workers[chat_id]
+
+    async def _throttle(self, chat_id):
+        # Сначала ждем интервал своего чата, и только готовый к отправке чат
+        # занимает ближайший слот общего лимита, чтобы не держать его за собой
+        loop = asyncio.get_running_loop()
+        delay = self._chat_ready_at.get(chat_id, 0.0) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = loop.time()
+        slot = max(now, self._global_ready_at)
+        self._global_ready_at = slot + self.global_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        self._chat_ready_at[chat_id] = loop.time() + self.per_chat_interval
+
+    async def _send(self, chat_id, text):
+        # True - отправлено, False - отклонено без смысла повторять,
+        # None - попытки исчерпаны, можно доставить позже
+        for attempt in range(self.max_retries):
+            await self._throttle(chat_id)
+            start = time.perf_counter()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                metrics.observe("send_seconds", time.perf_counter() - start)
+                metrics.inc("notifications_sent")
+                logger.info("Уведомление отправлено в чат %s", chat_id)
+                return True
+            except RetryAfter as e:
+                metrics.inc("flood_waits")
+                delay = retry_after_seconds(e)
+                logger.warning("Превышен лимит Bot API, повтор через %.1f с", delay)
+                self._chat_ready_at[chat_id] = asyncio.get_running_loop().time() + delay
+            except BadRequest as e:
+                metrics.inc("send_failures")
+                logger.error("Ошибка при отправке уведомления: %s", e)
+                return False
+            except NetworkError as e:
+                metrics.inc("send_retries")
+                delay = min(2 ** attempt, 60)
+                logger.warning("Сетевая ошибка при отправке уведомления: %s, повтор через %d с", e, delay)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                metrics.inc("send_failures")
+                logger.error("Ошибка при отправке уведомления: %s", e)
+                return False
+        metrics.inc("send_failures")
+        logger.error("Уведомление в чат %s не отправлено после %d попыток", chat_id, self.max_retries)
+        return None
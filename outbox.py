@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+from notifier import Notification
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    chat_name TEXT NOT NULL,
+    link TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+class Outbox:
+    # Неотправленные уведомления на диске (SQLite в режиме WAL).
+    # Добавления и подтверждения копятся в памяти и записываются одной транзакцией
+    # раз в commit_interval секунд (групповая фиксация): один fsync на пачку,
+    # а не на каждое упоминание. После падения теряется не больше одного интервала.
+
+    def __init__(self, path, commit_interval=0.2):
+        self.path = path
+        self.commit_interval = commit_interval
+        self._db = None
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._live = {}
+        self._inserts = {}
+        self._deletes = set()
+        self._task = None
+        self._writing = None
+        metrics.gauge("outbox_backlog", lambda: len(self))
+
+    def __len__(self):
+        return len(self._live)
+
+    def load(self):
+        # Открывает базу и возвращает уведомления, не отправленные до остановки
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = FULL")
+        self._db.executescript(SCHEMA)
+        pending = []
+        for outbox_id, chat_id, user, chat_name, link, created_at in self._db.execute(
+            "SELECT id, chat_id, user, chat_name, link, created_at FROM outbox ORDER BY id"
+        ):
+            pending.append(Notification(chat_id, user, chat_name, link, outbox_id=outbox_id))
+            self._live[outbox_id] = created_at
+            self._next_id = outbox_id + 1
+        if pending:
+            logger.info("В outbox найдено неотправленных уведомлений: %d", len(pending))
+        return pending
+
+    def add(self, notification):
+        notification.outbox_id = self._next_id
+        self._next_id += 1
+        created_at = time.time()
+        self._live[notification.outbox_id] = created_at
+        self._inserts[notification.outbox_id] = (
+            notification.outbox_id, notification.chat_id, notification.user,
+            notification.chat_name, notification.link, created_at,
+        )
+
+    def ack(self, notifications):
+        for notification in notifications:
+            outbox_id = notification.outbox_id
+            if outbox_id is None or self._live.pop(outbox_id, None) is None:
+                continue
+            # Уведомление, отправленное до фиксации, на диск вообще не попадает
+            if self._inserts.pop(outbox_id, None) is None:
+                self._deletes.add(outbox_id)
+
+    def oldest_age(self):
+        if not self._live:
+            return None
+        return time.time() - next(iter(self._live.values()))
+
+    def _snapshot(self):
+        if not self._inserts and not self._deletes:
+            return None
+        snapshot = (list(self._inserts.values()), list(self._deletes))
+        self._inserts = {}
+        self._deletes = set()
+        return snapshot
+
+    def _write(self, snapshot):
+        # Выполняется в отдельном потоке и не трогает буферы: неудачная пачка
+        # возвращается и объединяется с буферами уже в event loop
+        inserts, deletes = snapshot
+        start = time.perf_counter()
+        try:
+            with self._lock, self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO outbox (id, chat_id, user, chat_name, link, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    inserts,
+                )
+                self._db.executemany("DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in deletes])
+        except Exception as e:
+            logger.error("Ошибка при записи outbox: %s", e)
+            return snapshot
+        metrics.inc("outbox_commits")
+        metrics.observe("outbox_commit_seconds", time.perf_counter() - start)
+        return None
+
+    def _requeue(self, snapshot):
+        # Возвращаем пачку в буфер, чтобы повторить при следующей фиксации.
+        # Уже подтвержденные за это время уведомления повторно не пишем.
+        inserts, deletes = snapshot
+        for row in inserts:
+            if row[0] in self._live:
+                self._inserts.setdefault(row[0], row)
+        self._deletes.update(deletes)
+
+    def flush(self):
+        snapshot = self._snapshot()
+        if snapshot is not None:
+            failed = self._write(snapshot)
+            if failed is not None:
+                self._requeue(failed)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writing is not None:
+            # Запись в потоке отменой задачи не прерывается, дожидаемся ее
+            # до финальной фиксации и закрытия базы
+            failed = await self._writing
+            self._writing = None
+            if failed is not None:
+                self._requeue(failed)
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.commit_interval)
+            snapshot = self._snapshot()
+            if snapshot is None:
+                continue
+            self._writing = asyncio.ensure_future(asyncio.to_thread(self._write, snapshot))
+            failed = await asyncio.shield(self._writing)
+            self._writing = None
+            if failed is not None:
+                self._requeue(failed)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Режим конвейера: процесс приема (Telethon) -> пул процессов сопоставления ->
+# отправка уведомлений в основном процессе вместе с обработчиками команд.
+# Между стадиями ограниченные очереди, поэтому при перегрузке прием замедляется,
+# а не растет память.
+#
+# message_key - ключ сообщения для дедупликации (bot.message_key).
+# Запись стадии приема:
+#   (chat_id, message_key, text, mention_texts, mention_user_ids,
+#    sender_id, sender_username, chat_title, chat_type, message_link)
+# Результат сопоставления:
+#   (chat_id, message_key, text, users, chat_title, chat_type, message_link)
+# Метрики дочерних процессов идут в той же очереди результатов раз в METRICS_INTERVAL секунд:
+#   ("metrics", (counters, histograms))
+
+METRICS_INTERVAL = 5.0
+
+def _metrics_message():
+    counters, histograms = metrics.take()
+    if counters or histograms:
+        return ("metrics", (counters, histograms))
+    return None
+
+def ingest_main(records, results, control, log_level):
+    from logging_setup import setup_logging
+
+    listener = setup_logging(log_level)
+    try:
+        asyncio.run(_run_ingest(records, results, control))
+    finally:
+        message = _metrics_message()
+        if message:
+            results.put(message)
+        listener.stop()
+
+async def _put(records, record):
+    try:
+        records.put_nowait(record)
+    except queue.Full:
+        metrics.inc("pipeline_backpressure")
+        await asyncio.get_running_loop().run_in_executor(None, records.put, record)
+
+async def _report_metrics(results):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        message = _metrics_message()
+        if message:
+            await loop.run_in_executor(None, results.put, message)
+
+async def _run_ingest(records, results, control):
+    import bot
+    from chat_scope import ChatScope
+
+    async def forward_event(event):
+        mention_texts, mention_user_ids = bot.extract_mentions(event.message)
+        try:
+            chat_info = await bot.chat_cache.resolve(event)
+        except Exception as e:
+            logger.error("Ошибка при получении данных чата %s: %s", event.chat_id, e)
+            return
+        sender = event.sender
+        await _put(records, (
+            event.chat_id, bot.message_key(event.message, event.chat_id), event.raw_text, mention_texts, mention_user_ids,
+            getattr(sender, 'id', None), getattr(sender, 'username', None),
+            chat_info.title, chat_info.type, chat_info.message_link(event.message.id),
+        ))
+
+    config = bot.load_config()
+    pool = bot.create_telethon_pool(config, forward_event)
+    loop = asyncio.get_running_loop()
+    reporter = asyncio.create_task(_report_metrics(results))
+    try:
+        await bot.start_telethon(pool, config, forward_event)
+        while True:
+            command, *args = await loop.run_in_executor(None, control.get)
+            if command == "stop":
+                break
+            if command == "scope":
+                scope = ChatScope.from_config({"CHAT_SCOPE": args[0]})
+                for account in pool.accounts:
+                    bot.subscribe_new_messages(account, scope, pool)
+    finally:
+        reporter.cancel()
+        await bot.stop_telethon(pool)
+
+def matcher_main(records, results, log_level, subscriptions_db):
+    from logging_setup import setup_logging
+    from subscriptions import SubscriptionStore
+
+    listener = setup_logging(log_level)
+    store = SubscriptionStore(subscriptions_db)
+    reported_at = time.monotonic()
+    try:
+        while True:
+            if time.monotonic() - reported_at >= METRICS_INTERVAL:
+                reported_at = time.monotonic()
+                message = _metrics_message()
+                if message:
+                    results.put(message)
+            try:
+                record = records.get(timeout=METRICS_INTERVAL)
+            except queue.Empty:
+                continue
+            if record is None:
+                break
+            (chat_id, message_key, text, mention_texts, mention_user_ids,
+             sender_id, sender_username, chat_title, chat_type, message_link) = record
+            # Изменения подписок из основного процесса замечаются по data_version SQLite
+            matcher = store.current_matcher()
+            if sender_id is not None:
+                matcher.remember_user_id(sender_id, sender_username)
+            start = time.perf_counter()
+            users = matcher.match(text, mention_texts, mention_user_ids)
+            metrics.observe("match_seconds", time.perf_counter() - start)
+            if users:
+                results.put((chat_id, message_key, text, users, chat_title, chat_type, message_link))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        message = _metrics_message()
+        if message:
+            results.put(message)
+        store.close()
+        listener.stop()
+
+class Pipeline:
+    def __init__(self, workers, queue_size=10000):
+        # spawn одинаково работает на всех платформах и не копирует в дочерние
+        # процессы потоки и event loop основного процесса
+        self._context = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.records = self._context.Queue(queue_size)
+        self.results = self._context.Queue(queue_size)
+        self.control = self._context.Queue()
+        self._ingest = None
+        self._matchers = []
+
+    def start(self, log_level, subscriptions_db):
+        self._ingest = self._context.Process(
+            target=ingest_main, args=(self.records, self.results, self.control, log_level), name="ingest",
+        )
+        self._ingest.start()
+        for index in range(self.workers):
+            process = self._context.Process(
+                target=matcher_main, args=(self.records, self.results, log_level, subscriptions_db),
+                name=f"matcher-{index}",
+            )
+            process.start()
+            self._matchers.append(process)
+        metrics.gauge("pipeline_records_depth", self.records.qsize)
+        metrics.gauge("pipeline_results_depth", self.results.qsize)
+        logger.info("Конвейер запущен: прием и %d обработчиков", self.workers)
+
+    async def consume(self, on_result):
+        loop = asyncio.get_running_loop()
+        while True:
+            result = await loop.run_in_executor(None, self.results.get)
+            if result is None:
+                break
+            if result[0] == "metrics":
+                metrics.merge(result[1])
+                continue
+            try:
+                on_result(result)
+            except Exception as e:
+                logger.error("Ошибка при обработке результата конвейера: %s", e)
+
+    def update_scope(self, scope_config):
+        self.control.put(("scope", scope_config))
+
+    def describe(self):
+        processes = ([self._ingest] if self._ingest else []) + self._matchers
+        alive = sum(1 for process in processes if process.is_alive())
+        try:
+            depth = f"{self.records.qsize()} / {self.results.qsize()}"
+        except NotImplementedError:
+            depth = "н/д"
+        return f"Процессов работает: {alive} из {len(processes)}, очереди (прием / результаты): {depth}"
+
+    async def stop(self, timeout=10.0):
+        loop = asyncio.get_running_loop()
+        if self._ingest is not None:
+            self.control.put(("stop",))
+            await loop.run_in_executor(None, self._ingest.join, timeout)
+            if self._ingest.is_alive():
+                self._ingest.terminate()
+        # Очередь записей может быть заполнена, а обработчики зависнуть: ждем место
+        # вне event loop и не дольше timeout, иначе завершаем процессы принудительно
+        try:
+            for _ in self._matchers:
+                await loop.run_in_executor(None, self.records.put, None, True, timeout)
+        except queue.Full:
+            logger.warning("Очередь записей не освободилась за %.0f с, обработчики будут завершены", timeout)
+        for process in self._matchers:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        await loop.run_in_executor(None, self.results.put, None)
+        logger.info("Конвейер остановлен")
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def atomic_write_json(path, data):
+    # Пишем во временный файл и переименовываем, чтобы читатель никогда
+    # не увидел наполовину записанный JSON
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def parse_key(key):
+    # Ключ контрольной точки: id чата или "аккаунт:id чата"
+    try:
+        return int(key)
+    except ValueError:
+        return key
+
+class CheckpointStore:
+    # Последний обработанный id сообщения по каждому чату.
+    # Обновляется в памяти после обработки сообщения, а на диск сбрасывается пачкой
+    # раз в flush_interval секунд и при остановке.
+    # Пока чат догоняется после перезапуска, живые события его точку не сдвигают:
+    # иначе при падении посреди догоняющего чтения непрочитанный промежуток потерялся бы.
+
+    def __init__(self, path, flush_interval=10.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._last_ids = {}
+        self._held = {}
+        self._dirty = False
+        self._task = None
+
+    def __len__(self):
+        return len(self._last_ids)
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self._last_ids = {parse_key(key): int(message_id) for key, message_id in json.load(f).items()}
+            except Exception as e:
+                logger.error("Ошибка при загрузке контрольных точек: %s", e)
+        logger.info("Загружено контрольных точек: %d", len(self._last_ids))
+
+    def get(self, chat_id):
+        return self._last_ids.get(chat_id, 0)
+
+    def items(self):
+        return list(self._last_ids.items())
+
+    def update(self, chat_id, message_id):
+        if chat_id in self._held:
+            self._held[chat_id] = max(self._held[chat_id], message_id)
+            return
+        self.progress(chat_id, message_id)
+
+    def migrate(self, old_key, new_key):
+        if old_key in self._last_ids:
+            self.progress(new_key, self._last_ids.pop(old_key))
+            self._dirty = True
+
+    def progress(self, chat_id, message_id):
+        # Продвижение догоняющего чтения применяется и к удерживаемому чату
+        if message_id > self._last_ids.get(chat_id, 0):
+            self._last_ids[chat_id] = message_id
+            self._dirty = True
+
+    def hold(self, chat_id):
+        self._held.setdefault(chat_id, 0)
+
+    def release(self, chat_id):
+        held = self._held.pop(chat_id, None)
+        if held:
+            self.progress(chat_id, held)
+
+    def release_all(self):
+        for chat_id in list(self._held):
+            self.release(chat_id)
+
+    def _snapshot(self):
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return {str(chat_id): message_id for chat_id, message_id in self._last_ids.items()}
+
+    def _write(self, snapshot):
+        try:
+            atomic_write_json(self.path, snapshot)
+        except Exception as e:
+            self._dirty = True
+            logger.error("Ошибка при сохранении контрольных точек: %s", e)
+
+    def flush(self):
+        snapshot = self._snapshot()
+        if snapshot is not None:
+            self._write(snapshot)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            snapshot = self._snapshot()
+            if snapshot is not None:
+                # Запись с fsync выполняется вне event loop
+                await asyncio.to_thread(self._write, snapshot)
@@ -0,0 +1,164 @@
+import json
+import logging
+import sqlite3
+import time
+
+from chat_scope import ChatScope
+from matcher import MentionMatcher, normalize_handle
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    chat_id INTEGER PRIMARY KEY,
+    scope TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    subscriber_id INTEGER NOT NULL REFERENCES subscribers(chat_id) ON DELETE CASCADE,
+    handle_key TEXT NOT NULL,
+    handle TEXT NOT NULL,
+    PRIMARY KEY (subscriber_id, handle_key)
+);
+CREATE INDEX IF NOT EXISTS subscriptions_by_handle ON subscriptions(handle_key);
+"""
+
+class SubscriptionStore:
+    # Подписчики (чаты, куда уходят уведомления), их отслеживаемые пользователи
+    # и области мониторинга в SQLite. В памяти держится инвертированный индекс
+    # пользователь -> подписчики, поэтому на сообщение нужен один проход
+    # сопоставления и рассылка только тем, кого оно касается.
+    # Изменения из других процессов замечаются по PRAGMA data_version.
+
+    def __init__(self, path, check_interval=2.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self.matcher = MentionMatcher([])
+        self._db = None
+        self._data_version = None
+        self._checked_at = float("-inf")
+        self._index = {}
+        self._handles = {}
+        self._scopes = {}
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA foreign_keys = ON")
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def reload(self):
+        db = self._connect()
+        index = {}
+        handles = {}
+        for subscriber_id, handle_key, handle in db.execute(
+            "SELECT subscriber_id, handle_key, handle FROM subscriptions"
+        ):
+            index.setdefault(handle_key, set()).add(subscriber_id)
+            handles.setdefault(handle_key, handle)
+        scopes = {}
+        for chat_id, scope in db.execute("SELECT chat_id, scope FROM subscribers"):
+            scopes[chat_id] = ChatScope.from_config({"CHAT_SCOPE": json.loads(scope)})
+        self._index = index
+        self._handles = handles
+        self._scopes = scopes
+        self._data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        self._checked_at = time.monotonic()
+        self.matcher = MentionMatcher(handles.values(), known_ids=self.matcher.known_ids)
+        self.version += 1
+        logger.info("Загружено подписчиков: %d, отслеживаемых пользователей: %d", len(scopes), len(handles))
+
+    def refresh_if_changed(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        if self._data_version is not None:
+            data_version = self._connect().execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return False
+            logger.info("Подписки изменены другим процессом, перечитываем")
+        self.reload()
+        return True
+
+    def current_matcher(self):
+        self.refresh_if_changed()
+        return self.matcher
+
+    def _write(self, query, params=()):
+        db = self._connect()
+        cursor = db.execute(query, params)
+        db.commit()
+        # Свои изменения применяем сразу, не дожидаясь проверки data_version
+        self.reload()
+        return cursor.rowcount
+
+    def is_subscriber(self, chat_id):
+        self.refresh_if_changed()
+        return chat_id in self._scopes
+
+    def subscribers(self):
+        self.refresh_if_changed()
+        return sorted(self._scopes)
+
+    def add_subscriber(self, chat_id):
+        return self._write("INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)", (chat_id,)) > 0
+
+    def remove_subscriber(self, chat_id):
+        return self._write("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,)) > 0
+
+    def get_scope(self, chat_id):
+        self.refresh_if_changed()
+        return self._scopes.get(chat_id) or ChatScope()
+
+    def set_scope(self, chat_id, scope):
+        self._write("UPDATE subscribers SET scope = ? WHERE chat_id = ?", (json.dumps(scope.to_config()), chat_id))
+
+    def add(self, subscriber_id, handle):
+        return self._write(
+            "INSERT OR IGNORE INTO subscriptions (subscriber_id, handle_key, handle) VALUES (?, ?, ?)",
+            (subscriber_id, normalize_handle(handle), handle),
+        ) > 0
+
+    def remove(self, subscriber_id, handle):
+        return self._write(
+            "DELETE FROM subscriptions WHERE subscriber_id = ? AND handle_key = ?",
+            (subscriber_id, normalize_handle(handle)),
+        ) > 0
+
+    def handles_for(self, subscriber_id):
+        self.refresh_if_changed()
+        return [
+            handle for handle, in self._connect().execute(
+                "SELECT handle FROM subscriptions WHERE subscriber_id = ? ORDER BY handle", (subscriber_id,)
+            )
+        ]
+
+    def import_handles(self, subscriber_id, handles):
+        db = self._connect()
+        db.execute("INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)", (subscriber_id,))
+        db.executemany(
+            "INSERT OR IGNORE INTO subscriptions (subscriber_id, handle_key, handle) VALUES (?, ?, ?)",
+            [(subscriber_id, normalize_handle(handle), handle) for handle in handles if normalize_handle(handle)],
+        )
+        db.commit()
+        self.reload()
+
+    @property
+    def handle_count(self):
+        return len(self._handles)
+
+    def subscribers_for(self, handle, chat_id, chat_type):
+        # Рассылка по инвертированному индексу с учетом области каждого подписчика
+        subscribers = self._index.get(normalize_handle(handle), ())
+        return [
+            subscriber_id for subscriber_id in subscribers
+            if subscriber_id in self._scopes and self._scopes[subscriber_id].allows(chat_id, chat_type)
+        ]
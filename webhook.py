@@ -0,0 +1,121 @@
+import asyncio
+import hmac
+import json
+import logging
+
+from telegram import Update
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+# Сколько ждать завершения текущих запросов при остановке
+STOP_TIMEOUT = 5.0
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+class WebhookServer:
+    # Прием обновлений Bot API по HTTP вместо long polling. Обновление кладется
+    # в update_queue приложения, дальше его обрабатывают обычные хендлеры PTB.
+    # Соединения keep-alive, Telegram переиспользует их между запросами.
+
+    def __init__(self, application, path, secret_token=None):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self._server = None
+        # Задача соединения -> writer, чтобы при остановке закрыть простаивающие соединения
+        self._connections = {}
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("Webhook слушает http://%s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        # Закрытие сокета будит ожидающий readline пустой строкой, и соединение
+        # завершается как обычно. Отменяем только те, что не успели за STOP_TIMEOUT.
+        tasks = list(self._connections)
+        for writer in self._connections.values():
+            writer.close()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        logger.info("Webhook остановлен")
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                # Соединение закрыто посреди заголовков
+                return None
+            if line in (b"\r\n", b"\n"):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_SIZE:
+            raise ValueError(f"слишком большое тело запроса: {length}")
+        body = await reader.readexactly(length) if length else b""
+        return request_line.decode("latin-1").split(), headers, body
+
+    async def _handle_request(self, parts, headers, body):
+        if len(parts) < 2 or parts[1].split("?")[0] != self.path:
+            return "404 Not Found"
+        if parts[0] != "POST":
+            return "405 Method Not Allowed"
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            metrics.inc("webhook_rejected")
+            logger.warning("Запрос к webhook с неверным секретом отклонен")
+            return "403 Forbidden"
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.error("Некорректное обновление в webhook: %s", e)
+            return "400 Bad Request"
+        await self.application.update_queue.put(update)
+        metrics.inc("webhook_updates")
+        return "200 OK"
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                parts, headers, body = request
+                status = await self._handle_request(parts, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Отмена возможна только из stop(). Задачу соединения создает asyncio,
+            # и отмененной она попала бы в лог с трассировкой.
+            pass
+        except Exception as e:
+            logger.debug("Ошибка при обработке запроса webhook: %s", e)
+        finally:
+            self._connections.pop(task, None)
+            writer.close()